@@ -1,5 +1,21 @@
+import asyncio
 import base64
+import hashlib
+import json
+import random
+import threading
+import time
+import weakref
+import aiohttp
 import requests
+from urllib.parse import urlparse
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import NewConnectionError
+from cache_utils import TTLCache, MISSING
+from concurrency_utils import shared
+from fetch_utils import TokenBucket
+from config import affinity_client_config, affinity_list_sync_ttl, affinity_page_size, affinity_sync_concurrency, \
+    cache_path
 
 url_affinity_organizations = "https://api.affinity.co/organizations"
 url_affinity_note = "https://api.affinity.co/notes"
@@ -7,6 +23,11 @@ url_affinity_persons = "https://api.affinity.co/persons"
 url_affinity_field_values = "https://api.affinity.co/field-values"
 url_affinity_list = "https://api.affinity.co/lists"
 deal_list_id = '143881'
+idempotent_methods = {"GET", "HEAD", "OPTIONS", "PUT", "DELETE"}  # safe to send again after a timeout or a 5xx
+list_entry_cache = TTLCache(cache_path, "affinity_list_index", max_memory_entries=4096)  # "list:entity" -> entry
+list_sync_cache = TTLCache(cache_path, "affinity_list_syncs")  # list id -> time of the last full sync
+organization_cache = TTLCache(cache_path, "affinity_organizations")  # normalized domain -> organization
+note_cache = TTLCache(cache_path, "affinity_notes")  # note_key -> note, so that a note is never posted twice
 def affinity_authorization(affinity_api_key):
     username = ""
     pwd = affinity_api_key
@@ -17,6 +38,161 @@ def affinity_authorization(affinity_api_key):
     return headers
 
 
+class AffinityResponse:
+    """
+    Body and status of an aiohttp response, read before its connection is released (same fields as requests). The
+    body is only parsed by json(), so that e.g. the HTML page of a 502 still reaches the retry logic.
+    """
+
+    def __init__(self, status_code: int, headers, text: str):
+        self.status_code = status_code
+        self.headers = headers
+        self.text = text
+
+    def json(self):
+        return json.loads(self.text)
+
+
+class AffinityClient:
+    """
+    Affinity API client sharing one pooled, kept-alive HTTP session between calls, with a timeout on every request.
+    Rate-limited (429), server (5xx) and connection errors are retried with backoff: the wait is read from the
+    Retry-After and X-Ratelimit-*-Reset headers when Affinity sends them, exponential with jitter otherwise. Requests
+    that create something (POST...) are only retried when Affinity can't have handled them, i.e. on 429 and when the
+    connection couldn't be opened: a timed-out or failed POST may have created the organization or note. When a
+    response says that the quota is used up, the next request waits for the reset. With a rate, requests are also
+    spaced by a token bucket shared by all the threads and event loops using the client.
+
+    request is synchronous (requests), arequest is the aiohttp version for event loops, with one session per loop.
+    Both return the last response, so the callers check status codes as before.
+    """
+
+    def __init__(self, api_key: str, timeout: float = 30.0, max_retries: int = 4, backoff_base: float = 1.0,
+                 backoff_max: float = 60.0, pool_size: int = 10, rate: float = None, burst: float = 1):
+        self.headers = affinity_authorization(api_key)
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.pool_size = pool_size
+        self.session = requests.Session()
+        self.session.headers.update(self.headers)
+        self.session.mount("https://", HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size))
+        self._async_sessions = weakref.WeakKeyDictionary()  # event loop -> aiohttp session
+        self._resume_at = 0.0  # monotonic time before which the quota is used up
+        self._lock = threading.Lock()
+        self.bucket = TokenBucket(rate, burst) if rate else None
+
+    def _pause(self) -> float:
+        """
+        Take a token from the bucket. :return: Seconds to wait before sending the request, for the bucket or until
+        the rate limit resets when the last response said that no request is left
+        """
+        wait = self.bucket.reserve() if self.bucket is not None else 0.0
+        with self._lock:
+            return max(wait, self._resume_at - time.monotonic())
+
+    def _observe(self, status_code: int, headers) -> float:
+        """
+        Track the rate-limit headers of a response.
+
+        :return: Seconds to wait before retrying, or None if the response is final
+        """
+        reset = None
+        for scope in ("User", "Org"):
+            remaining = headers.get(f"X-Ratelimit-Limit-{scope}-Remaining")
+            scope_reset = headers.get(f"X-Ratelimit-Limit-{scope}-Reset")
+            if remaining is not None and scope_reset is not None and float(remaining) <= 0:
+                reset = max(reset or 0.0, float(scope_reset))
+        if headers.get("Retry-After", "").isdigit():
+            reset = max(reset or 0.0, float(headers["Retry-After"]))
+        if reset is not None:
+            with self._lock:
+                self._resume_at = max(self._resume_at, time.monotonic() + reset)
+        if status_code == 429 or status_code >= 500:
+            return reset
+        return None
+
+    @staticmethod
+    def _retryable(method: str, status_code: int = None, error: Exception = None) -> bool:
+        """Whether a response or an exception is worth retrying for this method (see the class docstring)."""
+        if method.upper() in idempotent_methods:
+            return error is not None or status_code == 429 or status_code >= 500
+        if error is not None:
+            # the connection couldn't be opened, so nothing was sent
+            return isinstance(error, (requests.ConnectTimeout, aiohttp.ClientConnectorError)) \
+                or isinstance(getattr(error.args[0] if error.args else None, "reason", None), NewConnectionError)
+        return status_code == 429
+
+    def _backoff(self, attempt: int, wait: float = None) -> float:
+        if wait:
+            return min(wait, self.backoff_max)
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+
+    def request(self, method: str, url: str, **kwargs) -> requests.Response:
+        """Send a request with requests.Session.request arguments, retrying as described above."""
+        kwargs.setdefault("timeout", self.timeout)
+        for attempt in range(self.max_retries + 1):
+            time.sleep(self._pause())
+            try:
+                response = self.session.request(method, url, **kwargs)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                if attempt == self.max_retries or not self._retryable(method, error=e):
+                    raise
+                time.sleep(self._backoff(attempt))
+                continue
+            retryable = self._retryable(method, response.status_code)
+            wait = self._observe(response.status_code, response.headers)
+            if not retryable or attempt == self.max_retries:
+                return response
+            time.sleep(self._backoff(attempt, wait))
+
+    def get(self, url: str, **kwargs) -> requests.Response:
+        return self.request("GET", url, **kwargs)
+
+    def post(self, url: str, **kwargs) -> requests.Response:
+        return self.request("POST", url, **kwargs)
+
+    def _async_session(self) -> aiohttp.ClientSession:
+        loop = asyncio.get_running_loop()
+        session = self._async_sessions.get(loop)
+        if session is None or session.closed:
+            session = aiohttp.ClientSession(headers=self.headers, connector=aiohttp.TCPConnector(limit=self.pool_size),
+                                            timeout=aiohttp.ClientTimeout(total=self.timeout))
+            self._async_sessions[loop] = session
+        return session
+
+    async def arequest(self, method: str, url: str, **kwargs) -> AffinityResponse:
+        """Send a request with aiohttp.ClientSession.request arguments, retrying as described above."""
+        for attempt in range(self.max_retries + 1):
+            await asyncio.sleep(self._pause())
+            try:
+                async with self._async_session().request(method, url, **kwargs) as response:
+                    result = AffinityResponse(response.status, response.headers, await response.text())
+            except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as e:
+                if attempt == self.max_retries or not self._retryable(method, error=e):
+                    raise
+                await asyncio.sleep(self._backoff(attempt))
+                continue
+            retryable = self._retryable(method, result.status_code)
+            wait = self._observe(result.status_code, result.headers)
+            if not retryable or attempt == self.max_retries:
+                return result
+            await asyncio.sleep(self._backoff(attempt, wait))
+
+    async def aclose(self):
+        """Close the aiohttp session of the running event loop."""
+        session = self._async_sessions.pop(asyncio.get_running_loop(), None)
+        if session is not None:
+            await session.close()
+
+
+@shared
+def get_affinity_client(affinity_api_key) -> AffinityClient:
+    """Return the process-wide client of an API key."""
+    return AffinityClient(affinity_api_key, **affinity_client_config)
+
+
 def get_company_name(report: str, company_website: str):
     name = report.split('\n')[0]
     name = name.replace("*", "").replace(" report", "")
@@ -28,58 +204,174 @@ def get_company_name(report: str, company_website: str):
           name = tmp[0]
     return name.capitalize()
 
+def normalize_domain(website: str) -> str:
+    """"https://www.Example.com/about" -> "example.com", the key of the organization index"""
+    website = website.strip().lower()
+    host = urlparse(website if "://" in website else "//" + website).hostname or ""
+    return host[4:] if host.startswith("www.") else host
+
+def note_key(organization_id, note: str) -> str:
+    """Idempotency key of a note: the same memo is only added once to an organization."""
+    return f"{organization_id}:{hashlib.sha256(note.encode()).hexdigest()}"
+
 def create_organization_in_affinity(affinity_api_key, organization_data):
     """
     return
         whether the org already exists in Affinity,
         org details
     """
-    # Create headers with authentication
-    headers = affinity_authorization(affinity_api_key)
+    client = get_affinity_client(affinity_api_key)
+    domain = normalize_domain(organization_data.get("domain", ""))
+    organization = organization_cache.get(domain) if domain else MISSING
+    if organization is not MISSING:  # pushed before
+        return organization
 
     # First, search for the organization
     search_params = {"term": organization_data.get("domain", "")}
-    search_response = requests.get(url_affinity_organizations, headers=headers, params=search_params)
+    search_response = client.get(url_affinity_organizations, params=search_params)
 
     if search_response.status_code == 200:
         search_results = search_response.json()
         if search_results["organizations"]:
             # Organization already exists
+            if domain:
+                organization_cache.set(domain, search_results["organizations"][0])
             return search_results["organizations"][0]
 
     # Make the POST request
     company_name = get_company_name(organization_data.get("report"),organization_data.get("domain"))
-    response = requests.post(url_affinity_organizations,
-                             json={"name": company_name, "domain": organization_data["domain"]}, headers=headers)
+    response = client.post(url_affinity_organizations,
+                           json={"name": company_name, "domain": organization_data["domain"]})
 
     # Check if the request was successful
     if response.status_code in [200, 201]:
+        if domain:
+            organization_cache.set(domain, response.json())
         return response.json()  #response will contains entity_id of the new organization
     else:
         return None
 
-def find_dict_by_entity_id(dict_list, target_id):
-    for dictionary in dict_list:
-        if dictionary.get("entity_id") == target_id:
-            return dictionary
-    return None
+class ListEntryIndex:
+    """
+    Index from entity_id to the entry of an Affinity list, persisted in the local cache (one row per entry) so that
+    membership checks are key lookups instead of downloads of the whole list.
+
+    The index is rebuilt page by page once it is older than sync_ttl. In between, the Affinity API has no way to
+    list only the entries that changed, so an entity missing from the index is checked with one request for its own
+    list entries, and entries added through add are recorded right away.
+    """
+
+    def __init__(self, client: AffinityClient, list_id, sync_ttl: float = 24 * 3600, page_size: int = 500):
+        self.client = client
+        self.list_id = str(list_id)
+        self.sync_ttl = sync_ttl
+        self.page_size = page_size
+        self._synced_at = None  # time of the last full sync
+        self._lock = threading.RLock()
+
+    def _key(self, entity_id) -> str:
+        return f"{self.list_id}:{entity_id}"
+
+    def _cached(self, entity_id) -> dict:
+        entry = list_entry_cache.get(self._key(entity_id))
+        return None if entry is MISSING else entry
+
+    @staticmethod
+    def _slim(entry: dict) -> dict:
+        return {"id": entry["id"], "list_id": entry["list_id"], "entity_id": entry["entity_id"],
+                "created_at": entry.get("created_at")}
+
+    def sync(self) -> bool:
+        """
+        Download every entry of the list, following the pages.
+
+        :return: False if the list couldn't be read
+        """
+        full_url = f"{url_affinity_list}/{self.list_id}/list-entries"
+        params = {"page_size": self.page_size}
+        entries = {}
+        while True:
+            response = self.client.get(full_url, params=params)
+            if response.status_code != 200:
+                print(f"Failed to read Affinity list {self.list_id}. Status code: {response.status_code}")
+                return False
+            page = response.json()
+            for entry in page["list_entries"]:
+                entries[self._key(entry["entity_id"])] = self._slim(entry)
+            if not page.get("next_page_token"):
+                break
+            params["page_token"] = page["next_page_token"]
+        with self._lock:
+            list_entry_cache.delete_prefix(f"{self.list_id}:")  # entries removed from the list since the last sync
+            list_entry_cache.set_many(entries)
+            self._synced_at = time.time()
+            list_sync_cache.set(self.list_id, self._synced_at)
+        return True
+
+    def ensure_synced(self) -> bool:
+        """Load the persisted index, syncing it if it is missing or older than sync_ttl. :return: False on failure"""
+        with self._lock:
+            if self._synced_at is None:
+                synced_at = list_sync_cache.get(self.list_id)
+                self._synced_at = synced_at if synced_at is not MISSING else None
+            if self._synced_at is not None and time.time() - self._synced_at <= self.sync_ttl:
+                return True
+            return self.sync()
+
+    def lookup(self, entity_id) -> dict:
+        """:return: The list entry of an entity, or None if it is not in the list (call ensure_synced first)"""
+        entry = self._cached(entity_id)
+        if entry is not None:
+            return entry
+        # added since the last sync?
+        return self._from_organization(self.client.get(f"{url_affinity_organizations}/{entity_id}"))
+
+    async def alookup(self, entity_id) -> dict:
+        """lookup for event loops."""
+        entry = self._cached(entity_id)
+        if entry is not None:
+            return entry
+        return self._from_organization(await self.client.arequest("GET", f"{url_affinity_organizations}/{entity_id}"))
+
+    def _from_organization(self, response) -> dict:
+        """Find the entry of this list among the list entries of an organization, and record it."""
+        if response.status_code == 200:
+            for entry in response.json().get("list_entries") or []:
+                if str(entry["list_id"]) == self.list_id:
+                    return self.add(entry)
+        return None
+
+    def add(self, entry: dict) -> dict:
+        """Record a new entry of the list, writing only its own row."""
+        list_entry_cache.set(self._key(entry["entity_id"]), self._slim(entry))
+        return entry
+
+
+@shared
+def _list_index(affinity_api_key, list_id: str) -> ListEntryIndex:
+    return ListEntryIndex(get_affinity_client(affinity_api_key), list_id, affinity_list_sync_ttl, affinity_page_size)
+
+
+def get_list_index(affinity_api_key, list_id) -> ListEntryIndex:
+    return _list_index(affinity_api_key, str(list_id))
+
+
 def add_entry_to_list(affinity_api_key, list_id, entity_id):# list_id is 143881
-    headers = affinity_authorization(affinity_api_key)
+    client = get_affinity_client(affinity_api_key)
     full_url = f"{url_affinity_list}/{list_id}/list-entries"
+    index = get_list_index(affinity_api_key, list_id)
     # First, check if the organization is already in the list
-    check_response = requests.get(full_url, headers=headers)
-    if check_response.status_code == 200:
-        existing_entries = check_response.json()
-        output = find_dict_by_entity_id(existing_entries, entity_id)
+    if index.ensure_synced():
+        output = index.lookup(entity_id)
         if output:
             return output
         else:
-            # if the entry doesnt' exist, either because check_response is 404 or the return list is >1, Make the POST request
-            response = requests.post(full_url, json={"entity_id": entity_id}, headers=headers)
+            # if the entry doesnt' exist, Make the POST request
+            response = client.post(full_url, json={"entity_id": entity_id})
             # Check if the request was successful
             if response.status_code in [200, 201]:
                 print("Organization added to list successfully!")
-                return response.json()
+                return index.add(response.json())
             else:
                 print(f"Failed to add organization to list. Status code: {response.status_code}")
                 print(f"Response: {response.text}")
@@ -89,17 +381,119 @@ def add_entry_to_list(affinity_api_key, list_id, entity_id):# list_id is 143881
 
 
 def add_notes_to_company(affinity_api_key, organization_id, note):
-    headers = affinity_authorization(affinity_api_key)
+    client = get_affinity_client(affinity_api_key)
+    existing = note_cache.get(note_key(organization_id, note))
+    if existing is not MISSING:
+        print("This note was already added to the company")
+        return existing
     note_data = {"organization_ids": [organization_id], "content": note}
-    response = requests.post(url_affinity_note, headers=headers, json=note_data)
+    response = client.post(url_affinity_note, json=note_data)
     # if response.status_code == 201:
     if response.status_code in [200, 201]:
         print("Notes added to the company successfully! Status code: {response.status_code}")
+        note_cache.set(note_key(organization_id, note), response.json())
         return response.json()
     else:
         print(f"Failed to add notes to the company. Status code: {response.status_code}")
         print(f"Response: {response.text}")
         return None
+
+
+async def resolve_organization(client: AffinityClient, domain: str, report: str):
+    """
+    Find the organization of a normalized domain in the local index, then in Affinity, or create it.
+
+    :return: (organization, whether it was created)
+    """
+    organization = organization_cache.get(domain)
+    if organization is not MISSING:
+        return organization, False
+    response = await client.arequest("GET", url_affinity_organizations, params={"term": domain})
+    if response.status_code == 200 and response.json()["organizations"]:
+        organization, created = response.json()["organizations"][0], False
+    else:
+        response = await client.arequest("POST", url_affinity_organizations,
+                                         json={"name": get_company_name(report, domain), "domain": domain})
+        if response.status_code not in [200, 201]:
+            raise RuntimeError(f"Failed to create the organization. Status code: {response.status_code}")
+        organization, created = response.json(), True
+    organization_cache.set(domain, organization)
+    return organization, created
+
+
+async def add_list_entry(client: AffinityClient, index: ListEntryIndex, organization_id, created: bool) -> dict:
+    entry = await index.alookup(organization_id) if not created else None
+    if entry is not None:
+        return entry
+    response = await client.arequest("POST", f"{url_affinity_list}/{index.list_id}/list-entries",
+                                     json={"entity_id": organization_id})
+    if response.status_code not in [200, 201]:
+        raise RuntimeError(f"Failed to add organization to list. Status code: {response.status_code}")
+    return index.add(response.json())
+
+
+async def add_note(client: AffinityClient, organization_id, note: str) -> dict:
+    key = note_key(organization_id, note)
+    existing = note_cache.get(key)
+    if existing is not MISSING:
+        return existing
+    response = await client.arequest("POST", url_affinity_note, json={"organization_ids": [organization_id],
+                                                                      "content": note})
+    if response.status_code not in [200, 201]:
+        raise RuntimeError(f"Failed to add notes to the company. Status code: {response.status_code}")
+    note_cache.set(key, response.json())
+    return response.json()
+
+
+async def bulk_sync_memos(affinity_api_key, memos: list, list_id=deal_list_id,
+                          max_concurrency: int = affinity_sync_concurrency) -> list:
+    """
+    Push many memos to Affinity: the organization of each website is found or created, added to the list and given
+    the memo as a note. Memos of the same website share one organization, up to max_concurrency websites are pushed
+    at the same time (the client's rate limit applies to all of them) and the list entry and notes of an
+    organization are added concurrently. Organizations, list entries and notes already pushed are recorded locally,
+    so running the same sync again creates nothing twice.
+
+    :param memos: List of (website, memo) tuples
+    :return: One dictionary per memo, in order: domain, organization_id, organization_created, list_entry_id, note_id,
+        status ("done" or "failed") and error
+    """
+    client = get_affinity_client(affinity_api_key)
+    index = get_list_index(affinity_api_key, list_id)
+    if not await asyncio.to_thread(index.ensure_synced):
+        raise RuntimeError(f"Affinity list {list_id} couldn't be read")
+    websites = {}
+    for position, (website, memo) in enumerate(memos):
+        websites.setdefault(normalize_domain(website), []).append(position)
+    results = [None] * len(memos)
+    semaphore = asyncio.Semaphore(max_concurrency)
+
+    async def push(domain, positions):
+        async with semaphore:
+            try:
+                organization, created = await resolve_organization(client, domain, memos[positions[0]][1])
+                texts = list(dict.fromkeys(memos[position][1] for position in positions))  # a note is posted once
+                entry, *notes = await asyncio.gather(
+                    add_list_entry(client, index, organization["id"], created),
+                    *[add_note(client, organization["id"], text) for text in texts])
+            except Exception as e:  # one failing website must not stop the sync
+                for position in positions:
+                    results[position] = {"domain": domain, "organization_id": None, "organization_created": False,
+                                         "list_entry_id": None, "note_id": None, "status": "failed",
+                                         "error": f"{type(e).__name__}: {e}"}
+                return
+        notes = dict(zip(texts, notes))
+        for position in positions:
+            note = notes[memos[position][1]]
+            results[position] = {"domain": domain, "organization_id": organization["id"],
+                                 "organization_created": created, "list_entry_id": entry["id"],
+                                 "note_id": note.get("id"), "status": "done", "error": ""}
+
+    try:
+        await asyncio.gather(*[push(domain, positions) for domain, positions in websites.items()])
+    finally:
+        await client.aclose()
+    return results
 #
 # async def get_startup_by_name(affinity_api_key, owner_value, startup_name):
 #     subnames = startup_name.split()
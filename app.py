@@ -1,13 +1,10 @@
 import streamlit as st
 import json
-from config import all_metrics, sorted_currency, research_config
-from startup_research import *
-from financial_analysis import *
+from config import all_metrics, sorted_currency, research_config, research_job_poll_seconds
 import os
-import re
 import asyncio
-import affinity_utils as au
-import anthropic
+# The research stack (gpt-researcher, LLM clients, pymupdf), the Yahoo stack (yahooquery, pandas) and the currency
+# rates are imported where they are first used, so loading the page pays for none of them (see import_profile.py)
 
 os.environ["OPENAI_API_KEY"] =  st.secrets["openai_api_key"] # Set the OpenAI API key as an environment variable
 os.environ["TAVILY_API_KEY"] = st.secrets["tavily_api_key"] # Set the Tavyly API key as an environment variable
@@ -16,7 +13,6 @@ os.environ["LLM_PROVIDER"]=research_config["llm_provider"]
 os.environ["FAST_LLM_MODEL"]=research_config["fast_llm_model"]
 os.environ["SMART_LLM_MODEL"]=research_config["smart_llm_model"]
 os.environ["MAX_ITERATIONS"]=research_config["max_iterations"]
-os.environ["DOC_PATH"] = os.path.join("company")
 
 
 AFFINITY_API_KEY = st.secrets["affinity_api_key"]
@@ -33,9 +29,55 @@ def write_credentials_to_files():
     with open('token.json', 'w') as token_file:
         json.dump(GOOGLE_TOKEN, token_file, indent=4)
 
+# Progress labels of the stages of conduct_research
+research_stages = {
+    "summary": "Summarizing the company website",
+    "online_report": "Researching online",
+    "online_check": "Fact checking the online report",
+    "offline_report": "Researching the uploaded documents",
+    "offline_check": "Fact checking the document report",
+    "combine": "Combining the reports",
+}
+
 def set_stage(stage):
     st.session_state.stage = stage
 
+def draft_memo():
+    set_stage(1)
+    st.session_state.job_id = None  # submitted once the inputs are ready
+    st.session_state.report = None
+
+def get_research_jobs():
+    from job_utils import get_research_jobs
+    return get_research_jobs()
+
+def show_research(job):
+    """Show each report of a research job as it is being written."""
+    running = [stage for stage, progress in job["stages"].items() if progress["status"] == "running"]
+    if job["status"] == "queued":
+        label, state = "Waiting for a free research worker...", "running"
+    elif job["status"] == "running":
+        label, state = (", ".join(research_stages[stage] for stage in running) or "Drafting call memo") + "...", "running"
+    elif job["status"] == "failed":
+        label, state = "Failed to draft the call memo", "error"
+    else:
+        label, state = "Call memo drafted", "complete"
+    with st.status(label, expanded=state != "complete", state=state):
+        for stage, progress in job["stages"].items():
+            block = st.container(border=True)  # expanders can't be nested in the status
+            block.markdown(f"**{research_stages[stage]}**")
+            block.markdown(progress["text"])
+    if job["status"] == "failed":
+        st.error(job["error"], icon="🚨")
+
+@st.fragment(run_every=research_job_poll_seconds)
+def poll_research(job_id):
+    """Refresh the progress of a running job, without rerunning the rest of the page, until it finishes."""
+    job = get_research_jobs().get(job_id)
+    if job is None or job["status"] in ["done", "failed"]:
+        st.rerun()  # show the memo
+    show_research(job)
+
 async def main():
     tab_startup, tab_peer = st.tabs(["Startup Research", "Peer Comparison"])
     # Initialize session state variables
@@ -47,6 +89,12 @@ async def main():
         st.session_state.website = None
     if 'stage' not in st.session_state:
         st.session_state.stage = 0
+    if 'sources' not in st.session_state:
+        st.session_state.sources = None
+    if 'deck' not in st.session_state:
+        st.session_state.deck = None  # (upload id, PitchDeck) of this session
+    if 'job_id' not in st.session_state:
+        st.session_state.job_id = None  # research job of this session, see job_utils
 
     with tab_startup:
         st.header("Research a startup and draft the call memo")
@@ -61,47 +109,64 @@ async def main():
         st.session_state.company_description = st.text_input(
             'Describe the company in a few sentences (or leave blank if website is provided)')
         uploaded_files = st.file_uploader("Upload any documents you have from the company.")
-        st.button("Draft call memo", on_click=set_stage, args=(1,))
-        if st.session_state.stage==1:
+        # parse the upload once per session, the reruns reuse it
+        if uploaded_files is None:
+            st.session_state.deck = None
+        elif st.session_state.deck is None or st.session_state.deck[0] != uploaded_files.file_id:
+            from deck_utils import PitchDeck
+            st.session_state.deck = (uploaded_files.file_id, PitchDeck(uploaded_files.getvalue(), uploaded_files.name))
+        deck = st.session_state.deck[1] if st.session_state.deck is not None else None
+        refresh = st.checkbox("Refresh earlier research: only redo the steps whose inputs changed, however old it is")
+        st.button("Draft call memo", on_click=draft_memo)
+        if st.session_state.stage==1 and st.session_state.job_id is None:
             if not website:
                 st.warning("Please add the startup website to enable drafting the call memo.", icon="🚨")
             else:
                 #check early if the pdf is encrypted BEFORE DOING ANY research
-                if uploaded_files is not None:  # if document provided
-                    #first check if encrypted
-                    if is_encrypted(uploaded_files.getvalue()):
-                        print("success!")
-                        passkey = st.text_input("Enter the password for the encrypted pdf:", type="password")
-                        tmp_button = st.button("Press enter to decrypt pdf with password")
-                        while 1==1:
-                            if tmp_button: #if button is pressed 
-                                if not passkey:
-                                    st.warning("Please add a password for the pdf.", icon="🚨")
-                                await decrypt_pdf(uploaded_files, passkey) #new_export_pdf called within
-                                break 
-                    else:
-                        await new_export_pdf(uploaded_files)
-
-                #research beginnings
-                st.session_state.report = await conduct_research(st.session_state, research_config, uploaded_files)
-        if st.session_state.stage>=1:
+                if deck is not None and deck.is_encrypted:
+                    passkey = st.text_input("Enter the password for the encrypted pdf:", type="password")
+                    if st.button("Press enter to decrypt pdf with password"):
+                        if not passkey:
+                            st.warning("Please add a password for the pdf.", icon="🚨")
+                        elif not deck.decrypt(passkey):
+                            st.error("Incorrect password! Unable to decrypt PDF.", icon="🚨")
+                    if deck.is_encrypted:
+                        st.stop()  # until the next password is entered
+
+                # the research runs in the background, reruns only read its progress
+                st.session_state.job_id = get_research_jobs().submit(website, st.session_state.company_description,
+                                                                     deck, refresh)
+        if st.session_state.stage>=1 and st.session_state.job_id is not None:
+            job = get_research_jobs().get(st.session_state.job_id)
+            if job is None:
+                st.error("The research was lost, please draft the call memo again.", icon="🚨")
+            elif job["status"] in ["queued", "running"]:
+                poll_research(st.session_state.job_id)
+            else:
+                show_research(job)
+                if job["status"] == "done":
+                    st.session_state.report = job["memo"]
+                    st.session_state.company_description = job["company_description"]
+                    st.session_state.sources = job["sources"]
+        if st.session_state.stage>=1 and st.session_state.report is not None:
             st.write(st.session_state.report)
             st.write("Company Description")
             st.write(st.session_state.company_description)
 
-            # industry, sub_sector = identify_industry(st.session_state.report)
+            # industry, sub_sector = await identify_industry(st.session_state.report)
             # st.write("The company is in: " + industry)
             # st.write("The specfic sub-sector is: " + sub_sector)
             # market_report = await industry_sector_report(industry, sub_sector)
             # st.write(market_report)
             #
             # st.write("The expert opinion is: ")
-            # opinion = expert_opinion(company=st.session_state.report, market=market_report)
+            # opinion = await expert_opinion(company=st.session_state.report, market=market_report)
             # st.write(opinion)
 
             # Add to Affinity
             st.button("Add to Affinity", on_click=set_stage, args=(2,))
         if st.session_state.stage==2:
+            import affinity_utils as au
             company_data = {
                 "report": st.session_state.report,
                 "domain": st.session_state.website,
@@ -130,11 +195,18 @@ async def main():
         year = st.text_input('Enter year (YYYY) or leave empty for most recent TTM', None)
 
         if st.button('Analyze'):
+            import pandas as pd
+            from financial_analysis import iter_company_results, format_dataframe
+            # Fill the table in as each company's metrics arrive
+            table = st.empty()
+            results = {}
+            results_df = pd.DataFrame()
             with st.spinner('Analyzing companies...'):
-                results_df = analyze_multiple_companies(companies, selected_metrics, target_currency, year)
-                formatted_df = format_dataframe(results_df)
-
-            st.write(formatted_df)
+                for company, company_data in iter_company_results(companies, selected_metrics, target_currency, year):
+                    results[company] = company_data
+                    ordered = [company for company in dict.fromkeys(companies) if company in results]
+                    results_df = pd.DataFrame(results)[ordered]
+                    table.write(format_dataframe(results_df))
 
             # Download button for CSV
             csv = results_df.to_csv(index=True)
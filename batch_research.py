@@ -0,0 +1,197 @@
+"""
+Headless batch research: draft first-pass call memos for a list of startups without the Streamlit UI.
+
+    python batch_research.py startups.csv --output memos --workers 4
+
+The CSV has a "website" column and optional "description" and "deck" (path to a PDF, relative to the CSV) columns.
+The API keys are read from the OPENAI_API_KEY, TAVILY_API_KEY and ANTHROPIC_API_KEY environment variables.
+
+Each memo is written to <output>/<website>.md as soon as it is finished and recorded in <output>/results.csv.
+Running the same command again resumes the batch: finished memos are skipped, and the stages of interrupted ones
+that were already done are read back from the research cache (see conduct_research) instead of being redone.
+
+With --affinity, the finished memos are then pushed to the Affinity deal list (API key from AFFINITY_API_KEY).
+Organizations, list entries and notes pushed before are skipped, so the push can be rerun as often as needed.
+"""
+import argparse
+import asyncio
+import csv
+import json
+import os
+import re
+import statistics
+import sys
+import time
+import types
+import affinity_utils as au
+from config import research_config
+from deck_utils import PitchDeck
+from startup_research import conduct_research, website_key
+
+result_fields = ["key", "website", "status", "seconds", "memo", "sources", "error"]
+
+
+def read_jobs(path: str) -> list:
+    """
+    :return: One job per distinct website of the CSV, as dictionaries with website, description, deck and key
+    """
+    jobs = {}
+    with open(path, newline="") as f:
+        for row in csv.DictReader(f):
+            row = {name.strip().lower(): (value or "").strip() for name, value in row.items() if name}
+            if not row.get("website"):
+                continue
+            key = website_key(row["website"])
+            deck = os.path.join(os.path.dirname(path), row["deck"]) if row.get("deck") else None  # relative to the CSV
+            jobs.setdefault(key, {"key": key, "website": row["website"], "description": row.get("description") or None,
+                                  "deck": deck})
+    return list(jobs.values())
+
+
+def file_name(key: str) -> str:
+    return re.sub(r"[^A-Za-z0-9.-]+", "_", key).strip("_")
+
+
+def read_results(path: str) -> dict:
+    """:return: Dictionary mapping each website key to its latest row of results.csv"""
+    if not os.path.exists(path):
+        return {}
+    with open(path, newline="") as f:
+        return {row["key"]: row for row in csv.DictReader(f)}
+
+
+def load_deck(job: dict):
+    """:return: The deck_utils.PitchDeck of a job, or None if the job has no deck"""
+    if not job["deck"]:
+        return None
+    with open(job["deck"], "rb") as f:
+        deck = PitchDeck(f.read(), os.path.basename(job["deck"]))
+    if deck.is_encrypted:
+        raise ValueError(f"The deck {job['deck']} is encrypted")
+    return deck
+
+
+async def run_job(job: dict, output: str, refresh: bool, stage_seconds: dict) -> dict:
+    """Draft the memo of one job and write it to disk. Stage durations are appended to stage_seconds."""
+    state = types.SimpleNamespace(website=job["website"], company_description=job["description"], sources=None)
+    deck = load_deck(job)
+    started = time.perf_counter()
+    stage_started = {}
+
+    def on_event(stage, kind, text):
+        if kind == "start":
+            stage_started[stage] = time.perf_counter()
+        elif kind == "done":
+            stage_seconds.setdefault(stage, []).append(time.perf_counter() - stage_started[stage])
+
+    memo = await conduct_research(state, research_config, deck, refresh, on_event=on_event)
+    path = os.path.join(output, file_name(job["key"]) + ".md")
+    with open(path + ".tmp", "w") as f:
+        f.write(memo)
+    os.replace(path + ".tmp", path)  # a memo file is never left half written
+    return {"status": "done", "seconds": round(time.perf_counter() - started, 1), "memo": path,
+            "sources": " ".join(state.sources or []), "error": ""}
+
+
+async def run_batch(jobs: list, output: str, workers: int = 4, refresh: bool = False) -> dict:
+    """
+    Draft the memos of the jobs that are not done yet, running up to `workers` of them at a time. A failed job is
+    recorded and retried by the next run.
+
+    :return: Summary of the run: counts, wall time, throughput and mean seconds per stage
+    """
+    os.makedirs(output, exist_ok=True)
+    results_path = os.path.join(output, "results.csv")
+    done = {key for key, row in read_results(results_path).items()
+            if row["status"] == "done" and os.path.exists(row["memo"])}
+    pending = [job for job in jobs if job["key"] not in done]
+    print(f"{len(jobs) - len(pending)} of {len(jobs)} memos already done, {len(pending)} to go")
+
+    new_file = not os.path.exists(results_path)
+    results_file = open(results_path, "a", newline="")
+    writer = csv.DictWriter(results_file, fieldnames=result_fields)
+    if new_file:
+        writer.writeheader()
+    semaphore = asyncio.Semaphore(workers)
+    stage_seconds = {}
+    counts = {"done": 0, "failed": 0}
+    started = time.perf_counter()
+
+    async def worker(job):
+        async with semaphore:
+            job_started = time.perf_counter()
+            try:
+                result = await run_job(job, output, refresh, stage_seconds)
+            except Exception as e:  # one failing startup must not stop the batch
+                result = {"status": "failed", "seconds": round(time.perf_counter() - job_started, 1), "memo": "",
+                          "sources": "", "error": f"{type(e).__name__}: {e}"}
+        writer.writerow({"key": job["key"], "website": job["website"], **result})
+        results_file.flush()
+        counts[result["status"]] += 1
+        elapsed = time.perf_counter() - started
+        print(f"[{counts['done'] + counts['failed']}/{len(pending)}] {job['website']}: {result['status']} in "
+              f"{result['seconds']}s ({counts['done'] / elapsed * 3600:.1f} memos/hour) {result['error']}")
+
+    try:
+        await asyncio.gather(*[worker(job) for job in pending])
+    finally:
+        results_file.close()
+    elapsed = time.perf_counter() - started
+    return {
+        "memos": counts["done"],
+        "failed": counts["failed"],
+        "skipped": len(jobs) - len(pending),
+        "seconds": round(elapsed, 1),
+        "memos_per_hour": round(counts["done"] / elapsed * 3600, 1) if elapsed else 0.0,
+        "stage_seconds": {stage: round(statistics.mean(seconds), 1) for stage, seconds in stage_seconds.items()},
+    }
+
+
+async def push_to_affinity(output: str, affinity_api_key: str) -> dict:
+    """
+    Push the finished memos of results.csv to Affinity (see affinity_utils.bulk_sync_memos).
+
+    :return: Summary of the push: counts of pushed and failed memos and of created organizations
+    """
+    rows = [row for row in read_results(os.path.join(output, "results.csv")).values()
+            if row["status"] == "done" and os.path.exists(row["memo"])]
+    memos = []
+    for row in rows:
+        with open(row["memo"]) as f:
+            memos.append((row["website"], f.read()))
+    results = await au.bulk_sync_memos(affinity_api_key, memos)
+    for row, result in zip(rows, results):
+        if result["status"] == "failed":
+            print(f"Affinity: {row['website']}: {result['error']}")
+    return {
+        "pushed": sum(result["status"] == "done" for result in results),
+        "failed": sum(result["status"] == "failed" for result in results),
+        "organizations_created": len({result["organization_id"] for result in results if result["organization_created"]}),
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Draft call memos for a CSV of startups")
+    parser.add_argument("csv", help="CSV with a website column and optional description and deck columns")
+    parser.add_argument("--output", default="memos", help="folder of the memos and results.csv")
+    parser.add_argument("--workers", type=int, default=4, help="startups researched at the same time")
+    parser.add_argument("--refresh", action="store_true",
+                        help="reuse earlier research however old it is, only redoing the stages whose inputs changed")
+    parser.add_argument("--affinity", action="store_true", help="push the finished memos to the Affinity deal list")
+    args = parser.parse_args(argv)
+
+    # same gpt-researcher settings as the app
+    os.environ.setdefault("LLM_PROVIDER", research_config["llm_provider"])
+    os.environ.setdefault("FAST_LLM_MODEL", research_config["fast_llm_model"])
+    os.environ.setdefault("SMART_LLM_MODEL", research_config["smart_llm_model"])
+    os.environ.setdefault("MAX_ITERATIONS", research_config["max_iterations"])
+
+    summary = asyncio.run(run_batch(read_jobs(args.csv), args.output, args.workers, args.refresh))
+    if args.affinity:
+        summary["affinity"] = asyncio.run(push_to_affinity(args.output, os.environ["AFFINITY_API_KEY"]))
+    print(json.dumps(summary, indent=2))
+    return 1 if summary["failed"] or summary.get("affinity", {}).get("failed") else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
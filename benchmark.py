@@ -0,0 +1,322 @@
+"""
+Offline benchmark of the peer-comparison path (analyze_multiple_companies + format_dataframe).
+
+Yahoo responses are recorded once into a fixture and replayed offline, so runs are repeatable and don't hit Yahoo:
+    python benchmark.py record Apple Microsoft Toyota ...      # live, stores fixtures/yahoo_peers.pkl
+    python benchmark.py synthesize --companies 50              # fake fixture for machines without network access
+    python benchmark.py run --sizes 10 100 1000 --output bench.json
+    python benchmark.py run --baseline bench.json              # exits with 1 if the path got slower
+Peer sets larger than the fixture reuse its companies under suffixed names ("Apple~3" -> "AAPL~3").
+"""
+import argparse
+import json
+import os
+import pickle
+import statistics
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+import numpy as np
+import pandas as pd
+import yahooquery
+import financial_analysis as fa
+from cache_utils import TTLCache
+from fetch_utils import FetchScheduler
+from config import all_metrics, yahoo_cache_max_entries, yahoo_max_concurrency
+
+default_fixture = os.path.join("fixtures", "yahoo_peers.pkl")
+copy_separator = "~"
+
+
+def new_fixture():
+    return {"search": {}, "income_statement": {}, "cash_flow": {}, "modules": {}}
+
+
+def base_name(name: str):
+    """Split a suffixed company name or symbol into its recorded name and suffix."""
+    base, _, suffix = name.partition(copy_separator)
+    return base, (copy_separator + suffix if suffix else "")
+
+
+class RecordingTicker:
+    """Live yahooquery Ticker that stores the per-symbol slice of every response in the fixture."""
+
+    def __init__(self, symbols, fixture: dict, **kwargs):
+        self.__dict__["_ticker"] = yahooquery.Ticker(symbols, **kwargs)
+        self.__dict__["_symbols"] = symbols if isinstance(symbols, list) else symbols.split()
+        self.__dict__["_fixture"] = fixture
+
+    def __setattr__(self, name, value):  # e.g. period1/period2 of the panel mode, symbols of a retry
+        setattr(self._ticker, name, value)
+        if name == "symbols":
+            self.__dict__["_symbols"] = value
+
+    def _statement(self, name, *args, **kwargs):
+        result = getattr(self._ticker, name)(*args, **kwargs)
+        if isinstance(result, pd.DataFrame):
+            for symbol in self._symbols:
+                if symbol in result.index:
+                    self._fixture[name][symbol] = result.loc[[symbol]]
+        return result
+
+    def income_statement(self, *args, **kwargs):
+        return self._statement("income_statement", *args, **kwargs)
+
+    def cash_flow(self, *args, **kwargs):
+        return self._statement("cash_flow", *args, **kwargs)
+
+    def get_modules(self, modules):
+        result = self._ticker.get_modules(modules)
+        if isinstance(result, dict):
+            for symbol, value in result.items():
+                if isinstance(value, dict):
+                    self._fixture["modules"].setdefault(symbol, {}).update(value)
+        return result
+
+
+class ReplayTicker:
+    """
+    Ticker serving recorded responses, waiting `latency` seconds per request to stand in for the HTTP round trip.
+    Like yahooquery's, the constructor sends two requests (session setup and crumb). ReplayTicker.requests counts the
+    requests of every instance.
+    """
+    requests = 0
+    requests_lock = threading.Lock()
+
+    def __init__(self, symbols, fixture: dict, latency: float = 0.0, **kwargs):
+        self.symbols = symbols if isinstance(symbols, list) else symbols.split()
+        self.fixture = fixture
+        self.latency = latency
+        self._request()
+        self._request()
+
+    def _request(self):
+        with ReplayTicker.requests_lock:
+            ReplayTicker.requests += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+    def _statement(self, name, *args, **kwargs):
+        self._request()
+        frames = []
+        for symbol in self.symbols:
+            base, suffix = base_name(symbol)
+            if base in self.fixture[name]:
+                frame = self.fixture[name][base]
+                frames.append(frame.set_axis([symbol] * len(frame)).rename_axis('symbol'))
+        if not frames:
+            return {symbol: "No fundamentals data found" for symbol in self.symbols}
+        return pd.concat(frames)
+
+    def income_statement(self, *args, **kwargs):
+        return self._statement("income_statement", *args, **kwargs)
+
+    def cash_flow(self, *args, **kwargs):
+        return self._statement("cash_flow", *args, **kwargs)
+
+    def get_modules(self, modules):
+        self._request()
+        result = {}
+        for symbol in self.symbols:
+            recorded = self.fixture["modules"].get(base_name(symbol)[0])
+            if recorded is None:
+                result[symbol] = "Quote not found for ticker symbol: " + symbol
+            else:
+                result[symbol] = {module: recorded[module] for module in modules if module in recorded}
+        return result
+
+
+def replay_search(fixture: dict, latency: float = 0.0):
+    def search(query, *args, **kwargs):
+        if latency:
+            time.sleep(latency)
+        base, suffix = base_name(query)
+        symbol = fixture["search"].get(fa.normalize_company_name(base))
+        return {"quotes": [{"symbol": symbol + suffix}] if symbol else []}
+    return search
+
+
+def use_cache_dir(cache_dir: str):
+    """Point every cache of financial_analysis to a fresh SQLite file so that a run starts cold."""
+    path = os.path.join(cache_dir, "benchmark.sqlite")
+    fa.symbol_cache = TTLCache(path, "symbols")
+    fa.symbol_override_cache = TTLCache(path, "symbol_overrides")
+    fa.yahoo_cache = TTLCache(path, "yahoo_modules", max_memory_entries=4096, max_disk_entries=yahoo_cache_max_entries)
+    fa.panel_cache = TTLCache(path, "statement_panels", max_disk_entries=yahoo_cache_max_entries)
+
+
+def record(companies: list, fixture_path: str):
+    """Run the peer comparison live against Yahoo and store every response in the fixture."""
+    fixture = new_fixture()
+    live_search = fa.search
+
+    def recording_search(query, *args, **kwargs):
+        result = live_search(query, *args, **kwargs)
+        quotes = result.get('quotes') if isinstance(result, dict) else None
+        fixture["search"][fa.normalize_company_name(query)] = quotes[0]['symbol'] if quotes else None
+        return result
+
+    with tempfile.TemporaryDirectory() as cache_dir:
+        use_cache_dir(cache_dir)
+        fa.search = recording_search
+        fa.Ticker = lambda symbols, **kwargs: RecordingTicker(symbols, fixture, **kwargs)
+        fa.analyze_multiple_companies(companies, all_metrics)
+    os.makedirs(os.path.dirname(fixture_path) or ".", exist_ok=True)
+    with open(fixture_path, "wb") as f:
+        pickle.dump(fixture, f)
+    print(f"Recorded {len(fixture['search'])} companies into {fixture_path}")
+
+
+def synthesize(count: int, fixture_path: str, seed: int = 0):
+    """Store a fixture of fake companies shaped like the recorded Yahoo responses."""
+    rng = np.random.default_rng(seed)
+    fixture = new_fixture()
+    currencies = ['USD', 'USD', 'USD', 'EUR', 'JPY', 'GBP']
+    for i in range(count):
+        name, symbol = f"Company {i}", f"SYM{i}"
+        currency = currencies[i % len(currencies)]
+        fixture["search"][fa.normalize_company_name(name)] = symbol
+        revenue = 10 ** rng.uniform(6, 11.5, 5)
+        dates = pd.to_datetime([f"{year}-12-31" for year in range(2019, 2023)] + ["2023-06-30"])
+        periods = ["12M"] * 4 + ["TTM"]
+        fixture["income_statement"][symbol] = pd.DataFrame({
+            "asOfDate": dates, "periodType": periods, "currencyCode": currency, "TotalRevenue": revenue,
+            "CostOfRevenue": revenue * rng.uniform(0.3, 0.9, 5), "NetIncome": revenue * rng.uniform(-0.2, 0.3, 5),
+        }, index=pd.Index([symbol] * 5, name='symbol'))
+        fixture["cash_flow"][symbol] = pd.DataFrame({
+            "asOfDate": dates, "periodType": periods, "currencyCode": currency,
+            "OperatingCashFlow": revenue * rng.uniform(-0.1, 0.3, 5),
+        }, index=pd.Index([symbol] * 5, name='symbol'))
+        market_cap = revenue[-1] * rng.uniform(0.5, 10)
+        fixture["modules"][symbol] = {
+            "summaryDetail": {"marketCap": market_cap, "currency": currency,
+                              "priceToSalesTrailing12Months": market_cap / revenue[-1], "trailingPE": rng.uniform(5, 60)},
+            "defaultKeyStatistics": {"enterpriseToRevenue": rng.uniform(0.5, 12)},
+            "assetProfile": {"fullTimeEmployees": int(rng.integers(10, 200000))},
+        }
+    os.makedirs(os.path.dirname(fixture_path) or ".", exist_ok=True)
+    with open(fixture_path, "wb") as f:
+        pickle.dump(fixture, f)
+    print(f"Synthesized {count} companies into {fixture_path}")
+
+
+def peer_set(fixture: dict, size: int) -> list:
+    names = [name for name, symbol in fixture["search"].items() if symbol]
+    return [names[i % len(names)] + (f"{copy_separator}{i // len(names)}" if i >= len(names) else "")
+            for i in range(size)]
+
+
+def run_once(companies: list, metrics: list, target_currency: str):
+    start = time.perf_counter()
+    results_df = fa.analyze_multiple_companies(companies, metrics, target_currency)
+    analyzed = time.perf_counter()
+    fa.format_dataframe(results_df)
+    return analyzed - start, time.perf_counter() - analyzed
+
+
+def benchmark(fixture: dict, sizes: list, repeat: int = 3, latency: float = 0.0, rate: float = None,
+              target_currency: str = 'EUR') -> list:
+    """
+    Replay the peer comparison for each peer-set size.
+    Replayed requests are not rate limited unless `rate` (requests per second) is given.
+
+    :return: One dictionary per size with cold (empty cache) and warm latencies in seconds, throughput in
+             companies per second, Ticker requests of a cold run and peak traced memory in MB
+    """
+    fa.search = replay_search(fixture, latency)
+    fa.Ticker = lambda symbols, **kwargs: ReplayTicker(symbols, fixture, latency)
+    fa.yahoo_scheduler = FetchScheduler(yahoo_max_concurrency, rate or 1e9, rate or 1e9, max_retries=0)
+    results = []
+    for size in sizes:
+        companies = peer_set(fixture, size)
+        cold, warm, formatting, requests = [], [], [], []
+        for _ in range(repeat):
+            with tempfile.TemporaryDirectory() as cache_dir:
+                use_cache_dir(cache_dir)
+                sent = ReplayTicker.requests
+                analyze_time, format_time = run_once(companies, all_metrics, target_currency)
+                requests.append(ReplayTicker.requests - sent)
+                cold.append(analyze_time)
+                formatting.append(format_time)
+                warm.append(run_once(companies, all_metrics, target_currency)[0])
+        with tempfile.TemporaryDirectory() as cache_dir:
+            use_cache_dir(cache_dir)
+            tracemalloc.start()
+            run_once(companies, all_metrics, target_currency)
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+        analyze_cold = statistics.median(cold)
+        results.append({
+            "size": size,
+            "analyze_cold_s": analyze_cold,
+            "analyze_warm_s": statistics.median(warm),
+            "format_s": statistics.median(formatting),
+            "throughput_cold": size / analyze_cold,
+            "yahoo_requests_cold": statistics.median(requests),
+            "peak_memory_mb": peak / 2 ** 20,
+        })
+    return results
+
+
+def find_regressions(results: list, baseline: list, tolerance: float, min_slowdown: float = 0.005) -> list:
+    """
+    :return: Descriptions of the latencies that grew by more than tolerance (and min_slowdown seconds) over baseline
+    """
+    baseline = {entry["size"]: entry for entry in baseline}
+    regressions = []
+    for entry in results:
+        reference = baseline.get(entry["size"])
+        if reference is None:
+            continue
+        for key in [key for key in entry if key.endswith("_s")]:
+            if key in reference and entry[key] > reference[key] * (1 + tolerance) \
+                    and entry[key] - reference[key] > min_slowdown:
+                regressions.append(f"{entry['size']} companies: {key} {reference[key]:.4f}s -> {entry[key]:.4f}s")
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Offline benchmark of the peer-comparison path")
+    parser.add_argument("--fixture", default=default_fixture)
+    commands = parser.add_subparsers(dest="command", required=True)
+    record_parser = commands.add_parser("record", help="record live Yahoo responses into the fixture")
+    record_parser.add_argument("companies", nargs="+")
+    synthesize_parser = commands.add_parser("synthesize", help="write a fixture of fake companies")
+    synthesize_parser.add_argument("--companies", type=int, default=50)
+    run_parser = commands.add_parser("run", help="replay the fixture and report latency, throughput and memory")
+    run_parser.add_argument("--sizes", type=int, nargs="+", default=[10, 100, 1000])
+    run_parser.add_argument("--repeat", type=int, default=3)
+    run_parser.add_argument("--latency", type=float, default=0.0, help="simulated seconds per Yahoo request")
+    run_parser.add_argument("--rate", type=float, help="rate limit in requests per second (default: none)")
+    run_parser.add_argument("--output", help="write the results to this JSON file")
+    run_parser.add_argument("--baseline", help="JSON results to compare against; exit with 1 on a slowdown")
+    run_parser.add_argument("--tolerance", type=float, default=0.2, help="allowed relative slowdown")
+    args = parser.parse_args(argv)
+
+    if args.command == "record":
+        record(args.companies, args.fixture)
+        return 0
+    if args.command == "synthesize":
+        synthesize(args.companies, args.fixture)
+        return 0
+
+    with open(args.fixture, "rb") as f:
+        fixture = pickle.load(f)
+    results = benchmark(fixture, args.sizes, args.repeat, args.latency, args.rate)
+    print(pd.DataFrame(results).set_index("size").round(4).to_string())
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = find_regressions(results, json.load(f), args.tolerance)
+        for regression in regressions:
+            print("REGRESSION " + regression)
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
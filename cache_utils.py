@@ -0,0 +1,119 @@
+import os
+import pickle
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+MISSING = object()  # returned by TTLCache.get when there is no fresh entry, so that None can be cached
+
+
+class TTLCache:
+    """
+    Key-value cache with an in-process LRU in front of an on-disk SQLite table.
+    Values are pickled and stored together with the time they were written, so every reader can apply its own TTL.
+    When max_disk_entries is set, the oldest entries are evicted from the table once it grows past that size.
+    """
+    prune_interval = 100  # number of writes between two size checks of the table
+
+    def __init__(self, path: str, table: str, max_memory_entries: int = 1024, max_disk_entries: int = None):
+        self.path = path
+        self.table = table
+        self.max_memory_entries = max_memory_entries
+        self.max_disk_entries = max_disk_entries
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+        self._table_ready = False
+        self._writes = 0
+
+    def _execute(self, query: str, params=(), many: bool = False):
+        if not self._table_ready:  # create the file lazily so that importing a module with a cache stays cheap
+            with self._lock:
+                if not self._table_ready:  # concurrent first callers wait for the table instead of skipping it
+                    os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+                    self._query(f"CREATE TABLE IF NOT EXISTS {self.table} "
+                                f"(key TEXT PRIMARY KEY, value BLOB, stored_at REAL)")
+                    self._table_ready = True
+        return self._query(query, params, many)
+
+    def _query(self, query: str, params=(), many: bool = False):
+        """Run a query, or with many=True run it once per tuple of params, in one transaction."""
+        conn = sqlite3.connect(self.path, timeout=30)
+        try:
+            with conn:
+                return conn.executemany(query, params).fetchall() if many else conn.execute(query, params).fetchall()
+        finally:
+            conn.close()
+
+    def _remember(self, key: str, entry: tuple):
+        with self._lock:
+            self._memory[key] = entry
+            self._memory.move_to_end(key)
+            while len(self._memory) > self.max_memory_entries:
+                self._memory.popitem(last=False)
+
+    def get_entry(self, key: str):
+        """
+        :return: (value, stored_at) tuple, or None if the key was never stored
+        """
+        with self._lock:
+            if key in self._memory:
+                self._memory.move_to_end(key)
+                return self._memory[key]
+        rows = self._execute(f"SELECT value, stored_at FROM {self.table} WHERE key = ?", (key,))
+        if not rows:
+            return None
+        entry = (pickle.loads(rows[0][0]), rows[0][1])
+        self._remember(key, entry)
+        return entry
+
+    def get(self, key: str, ttl: float = None):
+        """
+        :param ttl: Maximum age of the entry in seconds (default: never expires)
+        :return: The cached value, or MISSING if there is no entry younger than ttl
+        """
+        entry = self.get_entry(key)
+        if entry is None:
+            return MISSING
+        value, stored_at = entry
+        if ttl is not None and time.time() - stored_at > ttl:
+            return MISSING
+        return value
+
+    def set(self, key: str, value):
+        entry = (value, time.time())
+        self._execute(f"INSERT OR REPLACE INTO {self.table} (key, value, stored_at) VALUES (?, ?, ?)",
+                      (key, pickle.dumps(value), entry[1]))
+        self._remember(key, entry)
+        self._writes += 1
+        if self.max_disk_entries and self._writes % self.prune_interval == 0:
+            self.prune()
+
+    def set_many(self, items: dict):
+        """set every key -> value of items in one transaction."""
+        stored_at = time.time()
+        self._execute(f"INSERT OR REPLACE INTO {self.table} (key, value, stored_at) VALUES (?, ?, ?)",
+                      [(key, pickle.dumps(value), stored_at) for key, value in items.items()], many=True)
+        with self._lock:  # read back from the table on next use instead of flooding the LRU
+            for key in items:
+                self._memory.pop(key, None)
+        self._writes += len(items)
+        if self.max_disk_entries:
+            self.prune()
+
+    def prune(self):
+        """Evict the oldest entries until the table holds at most max_disk_entries rows."""
+        self._execute(f"DELETE FROM {self.table} WHERE key NOT IN "
+                      f"(SELECT key FROM {self.table} ORDER BY stored_at DESC LIMIT ?)", (self.max_disk_entries,))
+
+    def delete(self, key: str):
+        self._execute(f"DELETE FROM {self.table} WHERE key = ?", (key,))
+        with self._lock:
+            self._memory.pop(key, None)
+
+    def delete_prefix(self, prefix: str):
+        """Delete every key starting with prefix."""
+        self._execute(f"DELETE FROM {self.table} WHERE substr(key, 1, ?) = ?", (len(prefix), prefix))
+        with self._lock:
+            for key in [key for key in self._memory if key.startswith(prefix)]:
+                del self._memory[key]
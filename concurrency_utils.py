@@ -0,0 +1,57 @@
+import asyncio
+import functools
+import threading
+
+
+class BackgroundLoop:
+    """
+    Event loop running on a daemon thread, started on first use. Work submitted to it is shared by every Streamlit
+    session and rerun, each of which runs its own short-lived event loop.
+
+    :param name: Name of the thread
+    :param setup: Optional async function run on the loop when it starts, e.g. to create objects bound to it
+    """
+
+    def __init__(self, name: str, setup=None):
+        self.name = name
+        self.setup = setup
+        self._loop = None
+        self._lock = threading.Lock()
+
+    def _start(self):
+        with self._lock:
+            if self._loop is not None:
+                return
+            loop = asyncio.new_event_loop()
+            threading.Thread(target=loop.run_forever, name=self.name, daemon=True).start()
+            if self.setup is not None:
+                asyncio.run_coroutine_threadsafe(self.setup(), loop).result()
+            self._loop = loop
+
+    def submit(self, coroutine):
+        """
+        Schedule a coroutine on the loop.
+
+        :return: concurrent.futures.Future of its result
+        """
+        self._start()
+        return asyncio.run_coroutine_threadsafe(coroutine, self._loop)
+
+
+def shared(factory):
+    """
+    Decorator making factory(*args) return one process-wide instance per distinct args, created on first use only,
+    even when several threads ask for it at the same time.
+    """
+    instances = {}
+    lock = threading.Lock()
+
+    @functools.wraps(factory)
+    def get(*args):
+        if args not in instances:
+            with lock:
+                if args not in instances:
+                    instances[args] = factory(*args)
+        return instances[args]
+
+    return get
@@ -1,4 +1,4 @@
-from currency_converter import CurrencyConverter
+import os
 #-------------------------------------
 # Variables for Peer Comparisons
 #-------------------------------------
@@ -11,10 +11,49 @@ all_metrics = [
     'Gross margin',
     "P/S ratio",
     "P/E ratio",
+    "Net margin",
+    "Cash flow",
+    "EV/Revenue",
 ]
-# Currency selection
-c = CurrencyConverter()
-all_currency =sorted(list(c.currencies))
+# Yahoo Finance fetching
+yahoo_statements = ['income_statement', 'cash_flow']
+yahoo_modules = ['summaryDetail', 'defaultKeyStatistics', 'assetProfile']
+yahoo_batch_size = 50  # symbols per multi-symbol Ticker request
+peer_workers = 4  # batches of a streamed peer comparison fetched at the same time
+yahoo_max_workers = 8  # concurrent HTTP requests of one asynchronous Ticker (one request per symbol)
+# Shared Yahoo fetch scheduler, sized to stay below Yahoo's throttling threshold
+yahoo_max_concurrency = 4  # searches and Ticker batches in flight
+yahoo_rate_limit = 5  # HTTP requests per second
+yahoo_rate_burst = 20
+yahoo_max_retries = 4
+yahoo_backoff_base = 1.0  # seconds, doubled on every retry and jittered
+yahoo_backoff_max = 30.0
+# Local cache
+cache_path = os.path.join(".cache", "startup_research.sqlite")
+symbol_cache_ttl = 30 * 24 * 3600  # name -> ticker mappings almost never change
+symbol_negative_cache_ttl = 24 * 3600  # retry names that didn't resolve once a day
+# Names that Yahoo search resolves wrongly or not at all, keyed by lower-case company name
+symbol_overrides = {
+    "google": "GOOGL",
+    "alphabet": "GOOGL",
+    "meta": "META",
+    "facebook": "META",
+}
+# Freshness of each cached Yahoo module in seconds, matched to how often the underlying data changes
+yahoo_cache_ttl = {
+    "income_statement": 24 * 3600,  # annual and TTM statements change at most quarterly
+    "cash_flow": 24 * 3600,
+    "summaryDetail": 15 * 60,  # market cap and price multiples move during the trading day
+    "defaultKeyStatistics": 3600,
+    "assetProfile": 7 * 24 * 3600,  # employee counts and company profile
+}
+yahoo_cache_max_stale = 7 * 24 * 3600  # older entries are re-downloaded before use instead of served stale
+yahoo_cache_max_entries = 20000
+# Currency selection: the currencies of the ECB rate file of currency_converter, listed here so that the selector
+# doesn't parse the rate file on page load. Update the list when the CurrencyConverter pin in requirements.txt changes
+all_currency = ['AUD', 'BGN', 'BRL', 'CAD', 'CHF', 'CNY', 'CYP', 'CZK', 'DKK', 'EEK', 'EUR', 'GBP', 'HKD', 'HRK', 'HUF',
+                'IDR', 'ILS', 'INR', 'ISK', 'JPY', 'KRW', 'LTL', 'LVL', 'MTL', 'MXN', 'MYR', 'NOK', 'NZD', 'PHP', 'PLN',
+                'ROL', 'RON', 'RUB', 'SEK', 'SGD', 'SIT', 'SKK', 'THB', 'TRL', 'TRY', 'USD', 'ZAR']
 frequent_currency = ['JPY', 'USD','EUR']
 sorted_currency = sorted(all_currency, key=lambda x: frequent_currency.index(x) if x in frequent_currency else len(frequent_currency))
 
@@ -52,6 +91,51 @@ reference_prompt = """
 You MUST write all used source urls at the end of the report as references, and make sure to not add duplicated sources, but only one reference for each.
 """
 prompt = prompt+"\n" + reference_prompt
+# Section headers of the report, which check_point fact checks separately (longer names first where they overlap)
+report_sections = ["Website URL", "Website", "Team", "Market", "Product", "Traction", "Exit Strategy", "Concerns",
+                   "Deal Structure", "References"]
+unchecked_sections = ["References"]  # copied to the checked report as they are
+# Pitch deck ingestion: the deck is split into chunks and only the chunks most relevant to each section of the
+# report (BM25 search with the queries below) are given to the offline report
+deck_retrieval = {
+    "chunk_words": 200,
+    "chunk_overlap": 40,  # words shared by consecutive chunks of a page
+    "top_k": 3,  # chunks per query
+    "max_words": 3000,  # smaller decks are given whole
+    "parallel_pages": 40,  # larger decks are extracted on a process pool
+    "max_entries": 500,  # decks kept in the cache
+}
+deck_queries = {
+    "Team": "founder cofounder team ceo cto experience background previously university phd",
+    "Market": "market tam sam som size billion competition competitors landscape segment trend",
+    "Product": "product platform solution features technology customers problem alternative pricing",
+    "Traction": "traction customers revenue arr mrr growth pilots partnerships users retention channel sales",
+    "Exit Strategy": "exit acquisition acquirer ipo strategic comparable",
+    "Concerns": "risk risks challenges regulation regulatory dependency",
+    "Deal Structure": "raising raise round valuation funding use of funds investors seed series runway",
+}
+# Shared OpenAI client of the post-processing calls (check_point, combine_reports, ...)
+llm_client_config = {
+    "max_connections": 20,  # pooled HTTP connections kept alive between calls
+    "max_concurrency": 8,  # completions in flight across all sessions
+    "timeout": 180.0,  # seconds per completion
+    "max_retries": 2,
+}
+research_cache_ttl = 7 * 24 * 3600  # seconds before the cached research of a website is redone
+# background research jobs of the app (see job_utils.ResearchJobs), shared by all sessions
+research_jobs_config = {
+    "workers": 4,  # research jobs running at the same time, the others are queued
+    "ttl": 24 * 3600,  # seconds a finished job can be read back
+}
+research_job_poll_seconds = 1.0  # seconds between two refreshes of the progress of a running job in the app
+# Content-addressed cache of LLM responses. Modes: "cache" (reuse fresh responses), "record" (always call the
+# API and store the response), "replay" (only serve stored responses, for deterministic offline runs), "off"
+llm_cache_config = {
+    "mode": os.environ.get("LLM_CACHE_MODE", "cache"),
+    "path": os.environ.get("LLM_CACHE_PATH", cache_path),
+    "ttl": 7 * 24 * 3600,  # seconds, ignored in replay mode
+    "max_entries": 5000,
+}
 research_config = {
 	"llm_provider": "anthropic", #"openai", ##
 	"fast_llm_model": "claude-2.1", #"gpt-4o-mini", #
@@ -63,5 +147,33 @@ research_config = {
 	"role": """You are an experienced AI venture capital analyst assistant. Your primary objective is to produce comprehensive,
             insightful, and impartial investment analyses based on provided company information, market trends, and competitive landscapes.
             If you don’t know the precise answers, ask the investors to deep dive into those questions.
-    """
-}
\ No newline at end of file
+    """,
+    # seconds before a stage of conduct_research is cancelled
+    "stage_timeouts": {"summary": 300, "report": 900, "check_point": 300, "combine_reports": 300},
+}
+# gpt-researcher settings of each LLM provider. The research steps use research_config["llm_provider"] and fail over
+# to the others per call (see provider_utils)
+llm_providers = {
+    "anthropic": {"llm_provider": "anthropic", "fast_llm_model": "claude-2.1",
+                  "smart_llm_model": "claude-3-5-sonnet-20240620"},
+    "openai": {"llm_provider": "openai", "fast_llm_model": "gpt-4o-mini", "smart_llm_model": "gpt-4o"},
+}
+provider_router_config = {
+    "failure_threshold": 3,  # consecutive failures before a provider is skipped
+    "cooldown": 300,  # seconds before a skipped provider is tried again
+    "slow_seconds": 600,  # calls slower than this count as failures
+    "hedge_after": None,  # seconds before a slow call is also sent to the next provider (None: never)
+}
+# Shared Affinity API client (see affinity_utils.AffinityClient)
+affinity_client_config = {
+    "timeout": 30.0,  # seconds per request
+    "max_retries": 4,  # retries of rate-limited (429), server (5xx) and connection errors
+    "backoff_base": 1.0,  # seconds, doubled on every retry and jittered, unless Affinity says how long to wait
+    "backoff_max": 60.0,
+    "pool_size": 10,  # kept-alive connections
+    "rate": 10,  # requests per second, below Affinity's limit of 900 per minute
+    "burst": 20,
+}
+affinity_sync_concurrency = 8  # memos pushed at the same time by bulk_sync_memos
+affinity_list_sync_ttl = 24 * 3600  # seconds between full syncs of the local index of a list's entries
+affinity_page_size = 500  # list entries per page
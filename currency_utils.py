@@ -0,0 +1,82 @@
+import datetime
+import threading
+from functools import lru_cache
+import numpy as np
+from currency_converter import CurrencyConverter
+
+_converter = None
+_converter_lock = threading.Lock()
+
+
+def get_converter() -> CurrencyConverter:
+    """Return the process-wide CurrencyConverter, parsing the ECB rate file on first use only."""
+    global _converter
+    if _converter is None:
+        with _converter_lock:
+            if _converter is None:
+                _converter = CurrencyConverter(fallback_on_missing_rate=True, fallback_on_wrong_date=True)
+    return _converter
+
+
+def to_date(value):
+    """Normalize datetimes and pandas Timestamps to the datetime.date keys used by the rate file."""
+    if value is None or value != value:  # NaN and NaT
+        return None
+    if isinstance(value, datetime.datetime):  # pandas Timestamp is a datetime subclass
+        return value.date()
+    return value
+
+
+@lru_cache(maxsize=256)
+def get_rate_table(date: datetime.date = None):
+    """
+    Build the EUR value of one unit of every currency at a given date.
+
+    :param date: Date of the rates (default: latest available rates)
+    :return: (dictionary mapping each currency to its position, NumPy array of EUR rates)
+    """
+    converter = get_converter()
+    currencies = sorted(converter.currencies)
+    rates = np.empty(len(currencies))
+    for i, currency in enumerate(currencies):
+        try:
+            rates[i] = converter.convert(1, currency, 'EUR', date=date)
+        except Exception:  # no rate for this currency at this date
+            rates[i] = np.nan
+    return {currency: i for i, currency in enumerate(currencies)}, rates
+
+
+def get_rate_matrix(date: datetime.date = None):
+    """
+    :return: (dictionary mapping each currency to its position, matrix whose [i, j] entry converts currency i to j)
+    """
+    index, rates = get_rate_table(date)
+    return index, rates[:, None] / rates[None, :]
+
+
+def convert_values(values, from_currencies, to_currency: str, dates=None) -> np.ndarray:
+    """
+    Convert an array of values in mixed source currencies to one target currency in a vectorized operation.
+    Values whose currency or date has no known rate are returned unchanged.
+
+    :param values: Numeric values (NaN for missing values)
+    :param from_currencies: Currency of each value, or a single currency for all of them
+    :param to_currency: Currency to convert to
+    :param dates: Date of each value, or a single date for all of them (default: latest available rates)
+    :return: NumPy array of converted values
+    """
+    values = np.asarray(values, dtype=float)
+    from_currencies = np.broadcast_to(np.asarray(from_currencies, dtype=object), values.shape)
+    dates = np.broadcast_to(np.asarray(dates, dtype=object), values.shape)
+    dates = np.array([to_date(date) for date in dates.ravel()], dtype=object).reshape(values.shape)
+    converted = values.copy()
+    for date in set(dates.ravel().tolist()):
+        index, rates = get_rate_table(date)
+        if to_currency not in index:
+            continue
+        selected = dates == date
+        positions = np.array([index.get(currency, -1) for currency in from_currencies[selected]], dtype=int)
+        factors = np.where(positions >= 0, rates[positions] / rates[index[to_currency]], np.nan)
+        factors = np.where(np.isnan(factors), 1.0, factors)  # keep the original value if the conversion fails
+        converted[selected] = values[selected] * factors
+    return converted
@@ -0,0 +1,180 @@
+import hashlib
+import math
+import multiprocessing
+import os
+import re
+import shutil
+import tempfile
+import weakref
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pymupdf
+from cache_utils import TTLCache, MISSING
+from config import cache_path, deck_retrieval, deck_queries
+
+deck_cache = TTLCache(cache_path, "deck_chunks", max_memory_entries=32, max_disk_entries=deck_retrieval["max_entries"])
+
+
+def open_document(content: bytes, name: str):
+    extension = os.path.splitext(name)[1].lstrip(".").lower()
+    return pymupdf.open(stream=content, filetype=extension or "pdf")
+
+
+def extract_pages(content: bytes, name: str, password: str, start: int, stop: int) -> list:
+    """Text of pages start to stop - 1, opening the document in this process (documents can't be pickled)."""
+    document = open_document(content, name)
+    if password is not None:
+        document.authenticate(password)
+    return [document[number].get_text() for number in range(start, stop)]
+
+
+def tokenize(text: str) -> list:
+    return re.findall(r"[a-z0-9]+", text.lower())
+
+
+def chunk_pages(pages: list, chunk_words: int, overlap: int) -> list:
+    """
+    Split the text of every page into windows of chunk_words words, consecutive windows sharing `overlap` words.
+
+    :return: List of {"page": page number, "text": text} dictionaries in document order
+    """
+    chunks = []
+    step = max(1, chunk_words - overlap)
+    for number, text in enumerate(pages, start=1):
+        words = text.split()
+        for start in range(0, max(1, len(words) - overlap), step):
+            if words[start:start + chunk_words]:
+                chunks.append({"page": number, "text": " ".join(words[start:start + chunk_words])})
+    return chunks
+
+
+class BM25Index:
+    """Okapi BM25 ranking of a list of texts."""
+
+    def __init__(self, texts: list, k1: float = 1.5, b: float = 0.75):
+        self.k1 = k1
+        self.b = b
+        self.frequencies = [Counter(tokenize(text)) for text in texts]
+        self.lengths = np.array([sum(frequency.values()) for frequency in self.frequencies], dtype=float)
+        self.average_length = self.lengths.mean() if len(texts) else 0.0
+        document_frequency = Counter(term for frequency in self.frequencies for term in frequency)
+        self.idf = {term: math.log(1 + (len(texts) - count + 0.5) / (count + 0.5))
+                    for term, count in document_frequency.items()}
+
+    def scores(self, query: str) -> np.ndarray:
+        scores = np.zeros(len(self.frequencies))
+        norm = self.k1 * (1 - self.b + self.b * self.lengths / (self.average_length or 1.0))
+        for term in set(tokenize(query)):
+            if term in self.idf:
+                tf = np.array([frequency.get(term, 0) for frequency in self.frequencies], dtype=float)
+                scores += self.idf[term] * tf * (self.k1 + 1) / (tf + norm)
+        return scores
+
+    def search(self, query: str, k: int) -> list:
+        """:return: Positions of the (up to) k best matching texts, best first, leaving out texts that don't match"""
+        scores = self.scores(query)
+        return [position for position in np.argsort(-scores, kind="stable")[:k] if scores[position] > 0]
+
+
+class PitchDeck:
+    """
+    A document uploaded for one research session. It is opened once with pymupdf, and the same parsed document is
+    used to check the encryption, decrypt it and extract its text. The offline report reads the extracted text from
+    a temporary folder of this deck only (see export), so concurrent sessions never see each other's decks.
+
+    The extracted chunks and their BM25 index are cached by the SHA-256 of the deck, so the same deck is never
+    extracted twice. Large decks are extracted on a process pool.
+
+    :param content: Bytes of the document
+    :param name: File name, used to tell pymupdf the file type (default: PDF)
+    """
+
+    def __init__(self, content: bytes, name: str = "pitchdeck.pdf"):
+        self.content = content
+        self.name = name
+        self.hash = hashlib.sha256(content).hexdigest()
+        self.document = open_document(content, name)
+        self._password = None
+        self._ingested = None
+        self._doc_path = None
+
+    @property
+    def is_encrypted(self) -> bool:
+        """True while the deck needs a password to be read."""
+        return bool(self.document.is_encrypted)
+
+    def decrypt(self, password: str) -> bool:
+        """
+        :return: True if the password opened the deck
+        """
+        if not self.is_encrypted:
+            return True
+        if self.document.authenticate(password):
+            self._password = password  # for the extraction processes
+            return True
+        return False
+
+    def pages(self) -> list:
+        """
+        Text of every page, extracted on a process pool for decks of more than deck_retrieval["parallel_pages"].
+        Blocking: async callers run it (or ingest and export) in a thread.
+        """
+        page_count = self.document.page_count
+        if page_count <= deck_retrieval["parallel_pages"]:
+            return [page.get_text() for page in self.document]
+        workers = min(os.cpu_count() or 1, math.ceil(page_count / deck_retrieval["parallel_pages"]))
+        bounds = [page_count * worker // workers for worker in range(workers + 1)]
+        # spawn rather than fork: the callers (Streamlit, the research jobs) are multithreaded processes
+        with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn")) as executor:
+            parts = executor.map(extract_pages, *zip(*[(self.content, self.name, self._password, start, stop)
+                                                       for start, stop in zip(bounds, bounds[1:])]))
+            return [text for part in parts for text in part]
+
+    def ingest(self) -> dict:
+        """
+        Extract and chunk the deck and index the chunks, or load them from the cache.
+
+        :return: {"chunks": list of {"page", "text"} dictionaries, "index": BM25Index of the chunks}
+        """
+        if self._ingested is None:
+            if self.is_encrypted:
+                raise ValueError("The deck is encrypted, decrypt it with its password first")
+            key = f"{self.hash}:{deck_retrieval['chunk_words']}:{deck_retrieval['chunk_overlap']}"
+            ingested = deck_cache.get(key)
+            if ingested is MISSING:
+                chunks = chunk_pages(self.pages(), deck_retrieval["chunk_words"], deck_retrieval["chunk_overlap"])
+                ingested = {"chunks": chunks, "index": BM25Index([chunk["text"] for chunk in chunks])}
+                deck_cache.set(key, ingested)
+            self._ingested = ingested
+        return self._ingested
+
+    def relevant_chunks(self, queries: dict = None, top_k: int = None) -> list:
+        """
+        :param queries: Search query of each section of the report (default: config.deck_queries)
+        :param top_k: Chunks kept per query (default: deck_retrieval["top_k"])
+        :return: The chunks that best match any query, in document order, or every chunk of a deck shorter than
+            deck_retrieval["max_words"]
+        """
+        ingested = self.ingest()
+        chunks = ingested["chunks"]
+        if sum(len(chunk["text"].split()) for chunk in chunks) <= deck_retrieval["max_words"]:
+            return chunks
+        selected = set()
+        for query in (queries or deck_queries).values():
+            selected.update(ingested["index"].search(query, top_k or deck_retrieval["top_k"]))
+        return [chunks[position] for position in sorted(selected)]
+
+    def export(self) -> str:
+        """
+        Write the relevant chunks of the deck to a temporary folder, removed with the deck, for the offline report.
+
+        :return: Path of the folder, to use as DOC_PATH of gpt-researcher
+        """
+        if self._doc_path is None:
+            folder = tempfile.mkdtemp(prefix="pitchdeck-")
+            weakref.finalize(self, shutil.rmtree, folder, True)
+            with open(os.path.join(folder, os.path.splitext(self.name)[0] + ".txt"), "w") as f:
+                f.write("\n\n".join(f"[Page {chunk['page']}] {chunk['text']}" for chunk in self.relevant_chunks()))
+            self._doc_path = folder
+        return self._doc_path
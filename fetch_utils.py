@@ -0,0 +1,84 @@
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+
+class TokenBucket:
+    """Token-bucket rate limiter: `rate` tokens per second, bursts of up to `capacity` tokens."""
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def reserve(self, cost: float = 1) -> float:
+        """Take `cost` tokens without waiting. Costs above capacity borrow ahead. :return: Seconds to wait before use"""
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            self._tokens -= cost
+            return -self._tokens / self.rate if self._tokens < 0 else 0
+
+    def acquire(self, cost: float = 1):
+        """Take `cost` tokens, sleeping until the bucket has refilled enough."""
+        wait = self.reserve(cost)
+        if wait:
+            time.sleep(wait)
+
+
+class FetchScheduler:
+    """
+    Runs calls to a rate-limited API with bounded concurrency, a token-bucket rate limit and retries with
+    jittered exponential backoff.
+    """
+
+    def __init__(self, max_concurrency: int, rate: float, burst: float, max_retries: int = 3,
+                 backoff_base: float = 1.0, backoff_max: float = 30.0, retry_on: tuple = (Exception,)):
+        self.max_concurrency = max_concurrency
+        self.bucket = TokenBucket(rate, burst)
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.retry_on = retry_on
+        self._slots = threading.BoundedSemaphore(max_concurrency)
+
+    def backoff(self, attempt: int):
+        """Sleep before retry number `attempt` (0-based): full jitter over an exponentially growing window."""
+        time.sleep(random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt)))
+
+    def call(self, fn, *args, cost: float = 1, max_retries: int = None, **kwargs):
+        """
+        Call fn(*args, **kwargs) once a concurrency slot and `cost` rate-limit tokens are available.
+        Exceptions listed in retry_on are retried up to max_retries times (default: the scheduler's), the last one
+        is raised. Callers that retry on their own pass max_retries=0, so that retries don't multiply.
+        """
+        max_retries = self.max_retries if max_retries is None else max_retries
+        for attempt in range(max_retries + 1):
+            with self._slots:
+                self.bucket.acquire(cost)
+                try:
+                    return fn(*args, **kwargs)
+                except self.retry_on:
+                    if attempt == max_retries:
+                        raise
+            self.backoff(attempt)  # outside the slot so that other calls can proceed meanwhile
+
+    def map(self, fn, items: list) -> list:
+        """
+        Run fn on every item on max_concurrency threads, isolating failures. fn is expected to send its API
+        requests through call; map itself doesn't take a concurrency slot so that the two can be nested.
+
+        :return: List of (result, None) or (None, exception) tuples in the order of items
+        """
+        def run(item):
+            try:
+                return fn(item), None
+            except Exception as e:
+                return None, e
+
+        with ThreadPoolExecutor(max_workers=self.max_concurrency) as executor:
+            return list(executor.map(run, items))
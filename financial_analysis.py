@@ -1,13 +1,591 @@
 from yahooquery import Ticker, search
+import numpy as np
 import pandas as pd
 import os
-from currency_converter import CurrencyConverter
+import re
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from currency_utils import convert_values
+from cache_utils import TTLCache, MISSING
+from fetch_utils import FetchScheduler
+from config import (yahoo_modules, yahoo_statements, yahoo_batch_size, cache_path, symbol_cache_ttl,
+                    symbol_negative_cache_ttl, symbol_overrides, yahoo_cache_ttl, yahoo_cache_max_stale,
+                    yahoo_cache_max_entries, peer_workers, yahoo_max_workers, yahoo_max_concurrency,
+                    yahoo_rate_limit, yahoo_rate_burst, yahoo_max_retries, yahoo_backoff_base, yahoo_backoff_max)
+
+symbol_cache = TTLCache(cache_path, "symbols")
+symbol_override_cache = TTLCache(cache_path, "symbol_overrides")
+yahoo_cache = TTLCache(cache_path, "yahoo_modules", max_memory_entries=4096, max_disk_entries=yahoo_cache_max_entries)
+# Full statement histories of the panel mode, refreshed incrementally
+panel_cache = TTLCache(cache_path, "statement_panels", max_disk_entries=yahoo_cache_max_entries)
+# Stale entries are refreshed on this thread while the cached values are served
+refresh_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="yahoo-refresh")
+refreshing = set()
+refreshing_lock = threading.Lock()
+# Every Yahoo request (symbol search and module downloads) goes through this scheduler
+yahoo_scheduler = FetchScheduler(yahoo_max_concurrency, yahoo_rate_limit, yahoo_rate_burst, yahoo_max_retries,
+                                 yahoo_backoff_base, yahoo_backoff_max)
+# Beginnings of the yahooquery error messages that are worth retrying (throttling, server errors, timeouts), as opposed
+# to definitive ones like "Quote not found for ticker symbol: 1500.T", which may contain the same digits further on
+transient_error_pattern = re.compile(r"(?:HTTP(?: Error)?\s*)?(?:429|5\d\d)\b|Too Many Requests|Rate limit|"
+                                     r"Internal Server Error|Bad Gateway|Service Unavailable|Gateway Time-?out|"
+                                     r"(?:Read |Connect(?:ion)? )?timed out|Connection (?:reset|aborted|refused)|"
+                                     r"HTTPS?ConnectionPool\(", re.IGNORECASE)
+
+
+def normalize_company_name(company_name):
+    return " ".join(company_name.lower().split())
+
+
+def override_symbol(company_name, symbol):
+    """
+    Persist a manual name -> symbol mapping that takes precedence over Yahoo search. Pass symbol=None to remove it.
+    """
+    key = normalize_company_name(company_name)
+    if symbol is None:
+        symbol_override_cache.delete(key)
+    else:
+        symbol_override_cache.set(key, symbol)
+    symbol_cache.delete(key)
+
 
 def get_symbol(company_name):
-    results = search(company_name.capitalize())
-    if results:
-        return results['quotes'][0]['symbol']
-    return None
+    key = normalize_company_name(company_name)
+    symbol = symbol_override_cache.get(key)  # manual overrides win over the built-in ones
+    if symbol is not MISSING:
+        return symbol
+    if key in symbol_overrides:
+        return symbol_overrides[key]
+
+    entry = symbol_cache.get_entry(key)
+    if entry is not None:
+        symbol, stored_at = entry
+        ttl = symbol_cache_ttl if symbol else symbol_negative_cache_ttl  # names that didn't resolve are cached too
+        if time.time() - stored_at <= ttl:
+            return symbol
+
+    results = yahoo_scheduler.call(search, company_name.capitalize())
+    if results and results.get('quotes'):
+        symbol = results['quotes'][0]['symbol']
+    else:
+        symbol = None
+    symbol_cache.set(key, symbol)
+    return symbol
+
+
+def get_symbols(companies: list, errors: dict = None) -> dict:
+    """
+    Resolve every company name to its ticker symbol before any financial data is fetched.
+    Lookups run concurrently through the Yahoo scheduler; a failed lookup only affects its own company.
+
+    :param companies: List of company names
+    :param errors: Optional dictionary filled with the exception of each company whose lookup failed
+    :return: Dictionary mapping each company name to its symbol (None if not found or failed)
+    """
+    companies = list(dict.fromkeys(companies))
+    symbols = {}
+    for company, (symbol, error) in zip(companies, yahoo_scheduler.map(get_symbol, companies)):
+        symbols[company] = symbol
+        if error is not None:
+            print(f"Symbol lookup failed for {company}: {error}")
+            if errors is not None:
+                errors[company] = error
+    return symbols
+
+
+def missing_symbol_results(company: str, metrics: list, errors: dict) -> dict:
+    if company in errors:
+        return {metric: f"Symbol lookup failed for {company}" for metric in metrics}
+    return {metric: f"No symbol found for {company}" for metric in metrics}
+
+
+def transient_error(value) -> bool:
+    return isinstance(value, str) and transient_error_pattern.match(value.strip()) is not None
+
+
+def split_symbol_data(symbol: str, statements: dict, quote_summary) -> dict:
+    """
+    Split the data of one symbol out of the bulk responses of a multi-symbol Ticker.
+
+    :param symbol: Ticker symbol to extract
+    :param statements: Dictionary mapping each downloaded statement to its frame for the whole batch, indexed by symbol
+    :param quote_summary: Dictionary returned by Ticker.get_modules for the whole batch, or None if not requested
+    :return: Dictionary mapping each downloaded module (statement or Yahoo module name) to its data
+    """
+    data = {}
+    for module, statement in statements.items():
+        if isinstance(statement, pd.DataFrame) and symbol in statement.index:
+            data[module] = statement.loc[[symbol]].reset_index(drop=True)
+        else:
+            data[module] = pd.DataFrame()
+    if quote_summary is not None:
+        symbol_modules = quote_summary.get(symbol) if isinstance(quote_summary, dict) else None
+        if not isinstance(symbol_modules, dict):  # yahooquery returns an error string for failed symbols
+            symbol_modules = {}
+        for name in yahoo_modules:
+            value = symbol_modules.get(name)
+            data[name] = value if isinstance(value, dict) else {}
+    return data
+
+
+def new_ticker(symbols: list) -> Ticker:
+    """
+    Ticker of one batch. Its constructor sends the session setup and crumb requests of yahooquery, so it goes through
+    the scheduler too, and is created once per batch and reused for every module and retry of the batch.
+    """
+    return yahoo_scheduler.call(Ticker, symbols, asynchronous=True, max_workers=yahoo_max_workers, cost=2)
+
+
+def request_module(ticker: Ticker, symbols: list, module: str, quote_modules: list = None,
+                   since: pd.Timestamp = None):
+    """
+    Send one multi-symbol request for a statement, or for the quote modules when module is "quote_summary".
+    Failed requests are not retried here but by request_with_retries, which also retries single symbols.
+
+    :param ticker: Ticker of the batch (see new_ticker), pointed to symbols
+    :param since: Only request the statement periods from this date on (default: all periods)
+    :return: (dictionary mapping each symbol that got a definitive answer to its data, symbols to request again)
+    """
+    ticker.symbols = symbols
+    if module == "quote_summary":
+        result = yahoo_scheduler.call(ticker.get_modules, quote_modules, cost=len(symbols), max_retries=0)
+        data = {}
+        for symbol in symbols:
+            if transient_error(result.get(symbol) if isinstance(result, dict) else None):
+                continue
+            data[symbol] = split_symbol_data(symbol, {}, result)
+        return data, [symbol for symbol in symbols if symbol not in data]
+
+    if since is not None:
+        ticker.period1 = int(since.timestamp())
+        ticker.period2 = int(time.time())
+    result = yahoo_scheduler.call(getattr(ticker, module), cost=len(symbols), max_retries=0)
+    if isinstance(result, pd.DataFrame):
+        return {symbol: split_symbol_data(symbol, {module: result}, None) for symbol in symbols}, []
+    # yahooquery returns the raw responses of the whole batch as soon as one symbol failed: symbols without data
+    # get an empty statement, the others (and the throttled ones) are requested again
+    data, retry = {}, []
+    for symbol in symbols:
+        value = result.get(symbol) if isinstance(result, dict) else None
+        if isinstance(value, str) and not transient_error(value):
+            data[symbol] = {module: pd.DataFrame()}
+        else:
+            retry.append(symbol)
+    return data, retry
+
+
+def request_with_retries(ticker: Ticker, symbols: list, module: str, quote_modules: list = None,
+                         since: pd.Timestamp = None):
+    """
+    request_module, requesting the throttled or failed symbols again with jittered backoff.
+
+    :return: (dictionary mapping each symbol that got a definitive answer to its data, symbols still failing)
+    """
+    data, pending = {}, symbols
+    for attempt in range(yahoo_max_retries + 1):
+        try:
+            received, pending = request_module(ticker, pending, module, quote_modules, since)
+        except Exception as e:
+            print(f"Yahoo request for {module} failed: {e}")
+            received = {}
+        data.update(received)
+        if not pending or attempt == yahoo_max_retries:
+            break
+        yahoo_scheduler.backoff(attempt)
+    return data, pending
+
+
+def download_batch(batch: list, modules: list) -> dict:
+    """
+    Download modules for one batch of symbols, retrying throttled or failed symbols with jittered backoff.
+    Symbols still failing after the last retry get empty data, without affecting the rest of the batch.
+    """
+    quote_modules = [name for name in yahoo_modules if name in modules]
+    requests = [name for name in yahoo_statements if name in modules] + (["quote_summary"] if quote_modules else [])
+    data = {symbol: {} for symbol in batch}
+    ticker = new_ticker(batch)
+    for module in requests:
+        received, pending = request_with_retries(ticker, batch, module, quote_modules)
+        for symbol, symbol_data in received.items():
+            data[symbol].update(symbol_data)
+        for symbol in pending:
+            print(f"Giving up on {module} for {symbol}")
+            if module == "quote_summary":
+                data[symbol].update(split_symbol_data(symbol, {}, {}))
+            else:
+                data[symbol][module] = pd.DataFrame()
+    return data
+
+
+def download_financial_data(symbols: list, modules: list, batch_size: int = yahoo_batch_size) -> dict:
+    """
+    Download modules for many symbols with a few multi-symbol requests and store them in the cache.
+    Batches are downloaded concurrently under the rate limit of the Yahoo scheduler.
+
+    :param symbols: List of ticker symbols
+    :param modules: Statements ("income_statement", "cash_flow") and/or Yahoo module names to download
+    :param batch_size: Number of symbols per Ticker request
+    :return: Dictionary mapping each symbol to its downloaded module data
+    """
+    batches = [symbols[start:start + batch_size] for start in range(0, len(symbols), batch_size)]
+    data = {}
+    for batch, (batch_data, error) in zip(batches, yahoo_scheduler.map(lambda batch: download_batch(batch, modules),
+                                                                       batches)):
+        if error is not None:
+            print(f"Download failed for {', '.join(batch)}: {error}")
+            batch_data = {symbol: {} for symbol in batch}
+        for symbol, symbol_data in batch_data.items():
+            data[symbol] = symbol_data
+            for module, value in symbol_data.items():
+                if len(value):  # don't cache failed lookups, they are retried on the next request
+                    yahoo_cache.set(f"{symbol}:{module}", value)
+    return data
+
+
+def refresh_in_background(symbols: list, modules: list):
+    """Re-download stale cache entries on a background thread, skipping the ones already being refreshed."""
+    with refreshing_lock:
+        symbols = [symbol for symbol in symbols if symbol not in refreshing]
+        refreshing.update(symbols)
+    if not symbols:
+        return
+
+    def refresh():
+        try:
+            download_financial_data(symbols, modules)
+        finally:
+            with refreshing_lock:
+                refreshing.difference_update(symbols)
+
+    refresh_executor.submit(refresh)
+
+
+def fetch_financial_data(symbols: list, modules: list = None, batch_size: int = yahoo_batch_size) -> dict:
+    """
+    Get the statements and summary modules of many symbols, serving them from the cache when possible.
+    Fresh entries are used as is. Stale entries are served immediately and refreshed in the background.
+    Missing or too old entries are downloaded with a few multi-symbol requests.
+
+    :param symbols: List of ticker symbols
+    :param modules: Statements and/or Yahoo module names to get (default: all cached modules)
+    :param batch_size: Number of symbols per Ticker request
+    :return: Dictionary mapping each symbol to its module data
+    """
+    symbols = list(dict.fromkeys(symbol for symbol in symbols if symbol))
+    modules = list(yahoo_cache_ttl) if modules is None else modules
+    data = {symbol: {} for symbol in symbols}
+    missing_symbols, missing_modules = [], set()
+    stale_symbols, stale_modules = [], set()
+    now = time.time()
+    for symbol in symbols:
+        for module in modules:
+            entry = yahoo_cache.get_entry(f"{symbol}:{module}")
+            age = now - entry[1] if entry is not None else None
+            if age is None or age > yahoo_cache_max_stale:
+                missing_modules.add(module)
+                if not missing_symbols or missing_symbols[-1] != symbol:
+                    missing_symbols.append(symbol)
+                continue
+            data[symbol][module] = entry[0]
+            if age > yahoo_cache_ttl[module]:
+                stale_modules.add(module)
+                if not stale_symbols or stale_symbols[-1] != symbol:
+                    stale_symbols.append(symbol)
+
+    if missing_symbols:
+        downloaded = download_financial_data(missing_symbols, list(missing_modules), batch_size)
+        for symbol, symbol_modules in downloaded.items():
+            data[symbol].update(symbol_modules)
+    if stale_symbols:
+        refresh_in_background(stale_symbols, list(stale_modules))
+    return data
+
+
+# Each metric declares the Yahoo fields it reads as (module, field) pairs and a formula computing it for all
+# companies at once from the combined frame. Money metrics also declare the columns holding the currency
+# of their values and the date of the rates used to convert them (None: latest rates).
+metric_registry = {
+    "Revenue": {
+        "sources": [("income_statement", "TotalRevenue")],
+        "formula": lambda df: df["TotalRevenue"],
+        "unit": "money", "currency": "currencyCode", "date": "asOfDate",
+    },
+    "Cost of revenue": {
+        "sources": [("income_statement", "CostOfRevenue")],
+        "formula": lambda df: df["CostOfRevenue"],
+        "unit": "money", "currency": "currencyCode", "date": "asOfDate",
+    },
+    "Net income": {
+        "sources": [("income_statement", "NetIncome")],
+        "formula": lambda df: df["NetIncome"],
+        "unit": "money", "currency": "currencyCode", "date": "asOfDate",
+    },
+    "Cash flow": {
+        "sources": [("cash_flow", "OperatingCashFlow")],
+        "formula": lambda df: df["OperatingCashFlow"],
+        "unit": "money", "currency": "currencyCode", "date": "asOfDate",
+    },
+    "Valuation": {
+        "sources": [("summaryDetail", "marketCap"), ("summaryDetail", "currency")],
+        "formula": lambda df: df["marketCap"],
+        "unit": "money", "currency": "currency", "date": None,
+    },
+    "Employees": {
+        "sources": [("assetProfile", "fullTimeEmployees")],
+        "formula": lambda df: df["fullTimeEmployees"],
+        "unit": "count",
+    },
+    "Gross margin": {  # (Revenue - Cost of Revenue) / Revenue * 100
+        "sources": [("income_statement", "TotalRevenue"), ("income_statement", "CostOfRevenue")],
+        "formula": lambda df: (df["TotalRevenue"] - df["CostOfRevenue"]) / df["TotalRevenue"].where(df["TotalRevenue"] != 0) * 100,
+        "unit": "percent",
+    },
+    "Net margin": {
+        "sources": [("income_statement", "TotalRevenue"), ("income_statement", "NetIncome")],
+        "formula": lambda df: df["NetIncome"] / df["TotalRevenue"].where(df["TotalRevenue"] != 0) * 100,
+        "unit": "percent",
+    },
+    "P/S ratio": {
+        "sources": [("summaryDetail", "priceToSalesTrailing12Months")],
+        "formula": lambda df: df["priceToSalesTrailing12Months"],
+        "unit": "ratio",
+    },
+    "P/E ratio": {
+        "sources": [("summaryDetail", "trailingPE")],
+        "formula": lambda df: df["trailingPE"],
+        "unit": "ratio",
+    },
+    "EV/Revenue": {
+        "sources": [("defaultKeyStatistics", "enterpriseToRevenue")],
+        "formula": lambda df: df["enterpriseToRevenue"],
+        "unit": "ratio",
+    },
+}
+# Column used to pick the reporting period of each statement
+statement_key_fields = {"income_statement": "TotalRevenue", "cash_flow": "OperatingCashFlow"}
+
+
+def required_sources(metrics: list) -> dict:
+    """
+    :return: Dictionary mapping each module needed by the metrics to the fields read from it
+    """
+    sources = {}
+    for metric in metrics:
+        for module, field in metric_registry.get(metric, {}).get("sources", []):
+            sources.setdefault(module, [])
+            if field not in sources[module]:
+                sources[module].append(field)
+    for module in sources:
+        if module in statement_key_fields:  # needed to pick the period and convert the values
+            for field in ["asOfDate", "currencyCode", statement_key_fields[module]]:
+                if field not in sources[module]:
+                    sources[module].append(field)
+    return sources
+
+
+def select_statement_rows(statements: pd.DataFrame, key_field: str, year: int = None) -> pd.DataFrame:
+    """
+    Pick one reporting period per symbol from the combined statements of all companies.
+
+    :param statements: Statements of all companies with a "symbol" column
+    :param key_field: Column that must be reported for the latest period to be used
+    :param year: Year to use (default: the latest period)
+    :return: One row per symbol, indexed by symbol
+    """
+    if key_field not in statements.columns:
+        return pd.DataFrame()
+    if year is None:  # use the latest available numbers
+        statements = statements[statements[key_field].notna()].sort_values('asOfDate', ascending=False)
+    else:  # use the highest number of that year
+        statements = statements[statements['asOfDate'].dt.year == year].sort_values(key_field, ascending=True)
+    return statements.drop_duplicates('symbol', keep='first').set_index('symbol')
+
+
+def build_company_frame(data: dict, sources: dict, year: int = None) -> pd.DataFrame:
+    """
+    Combine the fetched data of all companies into one frame with one row per symbol and one column per field.
+
+    :param data: Dictionary returned by fetch_financial_data
+    :param sources: Dictionary returned by required_sources
+    :param year: Year to retrieve financial data for (default: the latest period)
+    :return: DataFrame indexed by symbol; fields a company doesn't report are NaN
+    """
+    frame = pd.DataFrame(index=list(data))
+    for module, fields in sources.items():
+        if module in statement_key_fields:
+            statements = [symbol_data[module].assign(symbol=symbol) for symbol, symbol_data in data.items()
+                          if isinstance(symbol_data.get(module), pd.DataFrame) and not symbol_data[module].empty]
+            if not statements:
+                continue
+            rows = select_statement_rows(pd.concat(statements, ignore_index=True), statement_key_fields[module], year)
+        else:
+            rows = pd.DataFrame.from_dict({symbol: symbol_data.get(module, {}) for symbol, symbol_data in data.items()},
+                                          orient='index')
+        # statements share asOfDate and currencyCode, the first statement read provides them
+        fields = [field for field in fields if field in rows.columns and field not in frame.columns]
+        frame = frame.join(rows[fields])
+    columns = list(dict.fromkeys(field for fields in sources.values() for field in fields))
+    frame = frame.reindex(columns=columns)
+    if 'currencyCode' in frame.columns:
+        frame['currencyCode'] = frame['currencyCode'].fillna('USD')
+    return frame
+
+
+def evaluate_metrics(frame: pd.DataFrame, metrics: list, target_currency: str = 'USD',
+                     historical_rates: bool = False) -> pd.DataFrame:
+    """
+    Evaluate the formulas of the requested metrics over a combined frame with columnar operations.
+
+    :param frame: Frame returned by build_company_frame or build_panel_frame
+    :param metrics: List of metrics to retrieve
+    :param target_currency: Currency to convert financial values to (default: USD)
+    :param historical_rates: Convert statement values with the rates of their reporting date instead of the latest
+    :return: DataFrame with the rows of frame and metrics as columns, "N/A" where a value is not available
+    """
+    results = pd.DataFrame(index=frame.index)
+    for metric in dict.fromkeys(metrics):
+        spec = metric_registry.get(metric)
+        if spec is None:
+            results[metric] = f"Metric '{metric}' not found or not implemented"
+            continue
+        values = pd.to_numeric(spec["formula"](frame), errors='coerce')
+        if spec["unit"] == "money":
+            dates = frame[spec["date"]].to_numpy(dtype=object) if spec["date"] and historical_rates else None
+            values = pd.Series(convert_values(values.to_numpy(), frame[spec["currency"]].to_numpy(dtype=object),
+                                              target_currency, dates), index=frame.index)
+        results[metric] = values.astype(object).where(values.notna(), "N/A")
+    return results
+
+
+def compute_metrics(data: dict, metrics: list, target_currency: str = 'USD', year: int = None) -> pd.DataFrame:
+    """
+    Compute the requested metrics for all companies at once with columnar operations.
+
+    :param data: Dictionary returned by fetch_financial_data
+    :param metrics: List of metrics to retrieve
+    :param target_currency: Currency to convert financial values to (default: USD)
+    :param year: Year to retrieve financial data for (default: the latest period)
+    :return: DataFrame with symbols as rows and metrics as columns, "N/A" where a value is not available
+    """
+    frame = build_company_frame(data, required_sources(metrics), year)
+    # Statement values of a past year are converted with the rates of their reporting date
+    return evaluate_metrics(frame, metrics, target_currency, historical_rates=year is not None)
+
+
+def merge_periods(stored: pd.DataFrame, downloaded: pd.DataFrame) -> pd.DataFrame:
+    """
+    Merge newly downloaded reporting periods into the stored statement history of one symbol.
+    Downloaded rows replace stored rows of the same period, and only the latest TTM row is kept.
+    """
+    if stored is None or stored.empty:
+        merged = downloaded
+    elif downloaded.empty:
+        merged = stored
+    else:
+        merged = pd.concat([stored, downloaded], ignore_index=True).drop_duplicates(['asOfDate', 'periodType'],
+                                                                                   keep='last')
+    if merged.empty:
+        return merged
+    trailing = merged['periodType'] == 'TTM'
+    if trailing.any():
+        merged = merged[~trailing | (merged['asOfDate'] == merged.loc[trailing, 'asOfDate'].max())]
+    return merged.sort_values('asOfDate').reset_index(drop=True)
+
+
+def fetch_statement_panels(symbols: list, statements: list, batch_size: int = yahoo_batch_size) -> dict:
+    """
+    Get the full annual + TTM history of statements, kept locally and refreshed incrementally.
+    Histories younger than their TTL are served as stored. Older ones only download the periods after their last
+    stored asOfDate; symbols without a stored history download everything Yahoo has.
+
+    :param symbols: List of ticker symbols
+    :param statements: Statements to get ("income_statement", "cash_flow")
+    :param batch_size: Number of symbols per Ticker request
+    :return: Dictionary mapping each symbol to its statement histories
+    """
+    symbols = list(dict.fromkeys(symbol for symbol in symbols if symbol))
+    panels = {symbol: {} for symbol in symbols}
+    now = time.time()
+    for statement in statements:
+        new_symbols, outdated = [], {}
+        for symbol in symbols:
+            entry = panel_cache.get_entry(f"{symbol}:{statement}")
+            if entry is None or entry[0].empty:
+                new_symbols.append(symbol)
+                continue
+            panels[symbol][statement] = entry[0]
+            if now - entry[1] > yahoo_cache_ttl[statement]:
+                outdated[symbol] = entry[0]['asOfDate'].max()
+
+        # Symbols with the oldest histories share a batch so that each request starts close to their last period
+        ordered = sorted(outdated, key=outdated.get)
+        requests = [(new_symbols[i:i + batch_size], None) for i in range(0, len(new_symbols), batch_size)]
+        requests += [(ordered[i:i + batch_size], outdated[ordered[i]] + pd.Timedelta(days=1))
+                     for i in range(0, len(ordered), batch_size)]
+        for batch, since in requests:
+            # symbols still failing after the retries keep their stored history and are refreshed on the next call
+            try:
+                ticker = new_ticker(batch)
+            except Exception as e:  # keep the stored histories
+                print(f"Yahoo session for {statement} failed: {e}")
+                continue
+            received, pending = request_with_retries(ticker, batch, statement, since=since)
+            for symbol, symbol_data in received.items():
+                panels[symbol][statement] = merge_periods(panels[symbol].get(statement), symbol_data[statement])
+                if not panels[symbol][statement].empty:  # also re-stamps histories without new periods
+                    panel_cache.set(f"{symbol}:{statement}", panels[symbol][statement])
+            for symbol in pending:
+                print(f"Giving up on {statement} for {symbol}")
+    return panels
+
+
+def build_panel_frame(panels: dict, data: dict, sources: dict) -> pd.DataFrame:
+    """
+    Combine the statement histories of all companies into one frame with one row per symbol and reporting period.
+    Fields of the summary modules describe the company today, so they are only filled in on its latest period.
+
+    :param panels: Dictionary returned by fetch_statement_panels
+    :param data: Dictionary returned by fetch_financial_data for the summary modules
+    :param sources: Dictionary returned by required_sources
+    :return: DataFrame indexed by (symbol, asOfDate, periodType)
+    """
+    keys = ['symbol', 'asOfDate', 'periodType']
+    frame = None
+    for module, fields in sources.items():
+        if module not in statement_key_fields:
+            continue
+        histories = [symbol_panels[module].assign(symbol=symbol) for symbol, symbol_panels in panels.items()
+                     if isinstance(symbol_panels.get(module), pd.DataFrame) and not symbol_panels[module].empty]
+        if not histories:
+            continue
+        history = pd.concat(histories, ignore_index=True)
+        fields = [field for field in fields if field in history.columns and field not in keys]
+        if frame is None:
+            frame = history[keys + fields]
+        else:
+            # statements share currencyCode, the first statement read provides it
+            fields = [field for field in fields if field not in frame.columns]
+            frame = frame.merge(history[keys + fields], on=keys, how='outer')
+    if frame is None:
+        frame = pd.DataFrame(columns=keys)
+    frame = frame.sort_values(['symbol', 'asOfDate']).reset_index(drop=True)
+
+    latest = ~frame.duplicated('symbol', keep='last')
+    for module, fields in sources.items():
+        if module in statement_key_fields:
+            continue
+        rows = pd.DataFrame.from_dict({symbol: symbol_data.get(module, {}) for symbol, symbol_data in data.items()},
+                                      orient='index')
+        for field in fields:
+            if field in rows.columns and field not in frame.columns:
+                frame[field] = frame['symbol'].map(rows[field]).where(latest)
+
+    columns = list(dict.fromkeys(field for fields in sources.values() for field in fields))
+    frame = frame.set_index(keys).reindex(columns=columns)
+    if 'currencyCode' in frame.columns:
+        frame['currencyCode'] = frame['currencyCode'].fillna('USD')
+    return frame
 
 
 def analyze_financial_data(company: str, metrics: list, target_currency: str = 'USD', year: int = None) -> dict:
@@ -25,158 +603,155 @@ def analyze_financial_data(company: str, metrics: list, target_currency: str = '
     if not symbol:
         return {metric: f"No symbol found for {company}" for metric in metrics}
 
-    ticker = Ticker(symbol)
-
-    # Fetch all potentially needed data
-    income_statement = pd.DataFrame(ticker.income_statement())
-    if year is None:  # use the latest available numbers
-        income_statement = income_statement[income_statement['TotalRevenue'].notna()].sort_values('asOfDate',
-                                                                                                  ascending=False)
-    else:  # use the highest number of that year
-        income_statement = income_statement[income_statement['asOfDate'].dt.year == year].sort_values('TotalRevenue',
-                                                                                                      ascending=True)
-    statistics = pd.DataFrame(ticker.summary_detail).T
-    key_stats = ticker.key_stats
-    profile = ticker.asset_profile
-    # balance_sheet = pd.DataFrame(ticker.balance_sheet())
-    # cash_flow = pd.DataFrame(ticker.cash_flow())
-
-    # Get the company's reporting currency
-    if not income_statement.empty and 'currencyCode' in income_statement.columns:
-        company_currency = income_statement['currencyCode'].iloc[0]
-    else:
-        company_currency = 'USD'
-        # Initialize currency converter
-    # c = CurrencyRates()
-    c = CurrencyConverter()
-
-    def convert_currency(value, from_currency, to_currency):
-        if from_currency == to_currency:
-            return value
-        try:
-            # rate = c.get_rate(from_currency, to_currency)
-            # return value * rate
-            return c.convert(value, from_currency, to_currency)
-        except:
-            return value  # Return original value if conversion fails
+    data = fetch_financial_data([symbol], list(required_sources(metrics)))
+    return compute_metrics(data, metrics, target_currency, year).loc[symbol].to_dict()
 
-    results = {}
-    for metric in metrics:
-        # metric = metric.lower()
-        ## money metrics
-        if 'Revenue' in metric:
-            if not income_statement.empty and 'TotalRevenue' in income_statement.columns:
-                value = income_statement['TotalRevenue'].iloc[0]
-                results[metric] = convert_currency(value, company_currency, target_currency)
-            else:
-                results[metric] = "N/A"
 
-        elif 'Cost of revenue' in metric:
-            if not income_statement.empty and 'CostOfRevenue' in income_statement.columns:
-                value = income_statement['CostOfRevenue'].iloc[0]
-                results[metric] = convert_currency(value, company_currency, target_currency)
-            else:
-                results[metric] = "N/A"
+def analyze_multiple_companies(companies: list, metrics: list, target_currency: str = 'USD',
+                               year: str = None) -> pd.DataFrame:
+    """
+    Analyze financial data for multiple companies and return results in a DataFrame.
 
-        elif 'Net income' in metric:
-            if not income_statement.empty and 'NetIncome' in income_statement.columns:
-                value = income_statement['NetIncome'].iloc[0]
-                results[metric] = convert_currency(value, company_currency, target_currency)
-            else:
-                results[metric] = "N/A"
+    :param companies: List of company names to analyze
+    :param metrics: List of metrics to retrieve for each company
+    :return: DataFrame with metrics as rows and companies as columns
+    """
+    if year is not None:
+        year = int(year)
+    # All symbols are resolved first, then the whole peer set is fetched in a few batched requests
+    return pd.DataFrame(analyze_company_batch(companies, metrics, target_currency, year))
 
-        elif 'Valuation' in metric:
-            if 'marketCap' in statistics.columns:
-                value = statistics['marketCap'].iloc[0]
-                report_currency = statistics['currency'].iloc[0]
-                results[metric] = convert_currency(value, report_currency, target_currency)
-            else:
-                results[metric] = "N/A"
-        elif 'Cash flow' in metric:
-            if not cash_flow.empty and 'CashFlowFromOperatingActivities' in cash_flow.columns:
-                value = cash_flow['CashFlowFromOperatingActivities'].iloc[-1]
-                results[metric] = convert_currency(value, company_currency, target_currency)
-            else:
-                results[metric] = "N/A"
-        ## non-money metrics
-        elif 'Employees' in metric:
-            if 'fullTimeEmployees' in profile[symbol]:
-                results[metric] = profile[symbol]['fullTimeEmployees']
-            else:
-                results[metric] = "N/A"
-
-        elif 'Gross margin' in metric:  # This is calculated as (Revenue - Cost of Revenue) / Revenue * 100.
-            if not income_statement.empty and 'TotalRevenue' in income_statement.columns and 'CostOfRevenue' in income_statement.columns:
-                revenue = income_statement['TotalRevenue'].iloc[0]
-                cost_of_revenue = income_statement['CostOfRevenue'].iloc[0]
-                if revenue != 0:
-                    gross_margin = (revenue - cost_of_revenue) / revenue * 100
-                    results[metric] = gross_margin
-                else:
-                    results[metric] = "N/A"
-            else:
-                results[metric] = "N/A"
-        elif 'P/S ratio' in metric:
-            if not statistics.empty and 'priceToSalesTrailing12Months' in statistics.columns:
-                results[metric] = statistics['priceToSalesTrailing12Months'].iloc[0]
-            else:
-                results[metric] = "N/A"
 
-        elif 'P/E ratio' in metric:
-            if not statistics.empty and 'trailingPE' in statistics.columns:
-                results[metric] = statistics['trailingPE'].iloc[0]
-            else:
-                results[metric] = "N/A"
+def analyze_company_batch(companies: list, metrics: list, target_currency: str = 'USD', year: int = None) -> dict:
+    """Resolve, fetch and compute the metrics of one batch of companies."""
+    errors = {}
+    symbols = get_symbols(companies, errors)
+    computed = None
+    if any(symbols.values()):
+        data = fetch_financial_data(list(symbols.values()), list(required_sources(metrics)))
+        computed = compute_metrics(data, metrics, target_currency, year)
+    results = {}
+    for company in companies:
+        symbol = symbols[company]
+        if not symbol:
+            results[company] = missing_symbol_results(company, metrics, errors)
         else:
-            results[metric] = f"Metric '{metric}' not found or not implemented"
-
+            results[company] = computed.loc[symbol].to_dict()
     return results
 
 
-def analyze_multiple_companies(companies: list, metrics: list, target_currency: str = 'USD',
-                               year: str = None) -> pd.DataFrame:
+def iter_company_results(companies: list, metrics: list, target_currency: str = 'USD', year: str = None,
+                         max_workers: int = peer_workers):
     """
-    Analyze financial data for multiple companies and return results in a DataFrame.
+    Analyze multiple companies and yield each company's metrics as soon as they are ready.
+    The first batch holds a single company so that the first row arrives after one company's worth of work;
+    the following batches double in size up to yahoo_batch_size and are fetched concurrently.
 
     :param companies: List of company names to analyze
     :param metrics: List of metrics to retrieve for each company
-    :return: DataFrame with metrics as rows and companies as columns
+    :param target_currency: Currency to convert financial values to (default: USD)
+    :param year: Year to retrieve financial data for (default: the latest period)
+    :param max_workers: Number of batches fetched at the same time
+    :return: Generator of (company, dictionary of metrics) tuples, in completion order
     """
-    results = {}
     if year is not None:
         year = int(year)
+    companies = list(dict.fromkeys(companies))
+    batches, start, size = [], 0, 1
+    while start < len(companies):
+        batches.append(companies[start:start + size])
+        start += size
+        size = min(size * 2, yahoo_batch_size)
+
+    with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="peer-batch") as executor:
+        futures = [executor.submit(analyze_company_batch, batch, metrics, target_currency, year) for batch in batches]
+        try:
+            for future in as_completed(futures):
+                try:
+                    yield from future.result().items()
+                except Exception as e:  # isolate the failure to the companies of this batch
+                    batch = batches[futures.index(future)]
+                    print(f"Analysis failed for {', '.join(batch)}: {e}")
+                    for company in batch:
+                        yield company, {metric: f"Failed to analyze {company}" for metric in metrics}
+        finally:  # stop fetching the remaining batches if the caller stops iterating
+            for future in futures:
+                future.cancel()
+
+
+def analyze_panel(companies: list, metrics: list, target_currency: str = 'USD') -> pd.DataFrame:
+    """
+    Analyze financial data for multiple companies over all their reporting periods (annual and TTM).
+    Statement values are converted with the rates of their reporting date.
+
+    :param companies: List of company names to analyze
+    :param metrics: List of metrics to retrieve for each company and period
+    :param target_currency: Currency to convert financial values to (default: USD)
+    :return: DataFrame indexed by (company, asOfDate, periodType) with metrics as columns
+    """
+    symbols = get_symbols(companies)
+    sources = required_sources(metrics)
+    statements = [module for module in sources if module in statement_key_fields]
+    modules = [module for module in sources if module not in statement_key_fields]
+    panels = fetch_statement_panels(list(symbols.values()), statements)
+    data = fetch_financial_data(list(symbols.values()), modules) if modules else {}
+    computed = evaluate_metrics(build_panel_frame(panels, data, sources), metrics, target_currency,
+                                historical_rates=True)
+
+    results = []
     for company in companies:
-        company_data = analyze_financial_data(company, metrics, target_currency, year)
-        results[company] = company_data
+        symbol = symbols[company]
+        if symbol and symbol in computed.index.get_level_values('symbol'):
+            results.append(pd.concat({company: computed.xs(symbol, level='symbol')}, names=['company']))
+    if not results:
+        return pd.DataFrame(columns=list(dict.fromkeys(metrics)))
+    return pd.concat(results)
 
-    df = pd.DataFrame(results)
-    return df
 
+money_metric_names = ['revenue', 'cost of revenue', 'valuation', 'net income', 'cash flow']
 
-def format_dataframe(df):
-    def format_value(value, metric):
-        if isinstance(value, (int, float)):
-            if metric.lower() in ['revenue', 'cost of revenue', 'valuation', 'net income']:
-                if abs(value) >= 1e9:
-                    return f" {value / 1e9:.2f}B"
-                elif abs(value) >= 1e6:
-                    return f"{value / 1e6:.2f}M"
-                elif abs(value) >= 1e3:
-                    return f"{value / 1e3:.2f}K"
-                else:
-                    return f"{value:.2f}"
-            elif 'ratio' in metric.lower():
-                return f"{value:.2f}"
-            elif 'employees' in metric.lower():
-                return f"{value:,.0f}"
-            elif 'margin' in metric.lower():
-                return f"{value:.2f}%"
-            else:
-                return f"{value:,.2f}"
-        return value
 
-    formatted_df = df.copy()
-    for index, row in formatted_df.iterrows():
-        formatted_df.loc[index] = row.apply(lambda x: format_value(x, index))
+def metric_unit(metric) -> str:
+    """Pick how the values of a metric row are displayed: money (K/M/B), ratio, count, percent or plain number."""
+    name = metric.lower()
+    if name in money_metric_names:
+        return "money"
+    elif 'ratio' in name:
+        return "ratio"
+    elif 'employees' in name:
+        return "count"
+    elif 'margin' in name:
+        return "percent"
+    return "number"
+
 
-    return formatted_df
\ No newline at end of file
+def format_values(values: np.ndarray, unit: str) -> list:
+    """
+    Format a whole array of numbers of one unit in one pass.
+
+    :param values: Float array
+    :param unit: Value returned by metric_unit
+    :return: List of formatted strings
+    """
+    if unit == "money":
+        magnitude = np.abs(values)
+        conditions = [magnitude >= 1e9, magnitude >= 1e6, magnitude >= 1e3]
+        scaled = np.select(conditions, [values / 1e9, values / 1e6, values / 1e3], values)
+        templates = np.select(conditions, [" {:.2f}B", "{:.2f}M", "{:.2f}K"], "{:.2f}")
+        return list(map(str.format, templates.tolist(), scaled.tolist()))
+    template = {"ratio": "{:.2f}", "count": "{:,.0f}", "percent": "{:.2f}%"}.get(unit, "{:,.2f}")
+    return list(map(template.format, values.tolist()))
+
+
+def format_dataframe(df):
+    """
+    Format the numbers of a metrics x companies frame for display, choosing the unit once per metric row.
+    Values that are not numbers (e.g. "N/A") are kept as is.
+    """
+    rows = df.to_numpy(dtype=object, copy=True)
+    for i, metric in enumerate(df.index):
+        row = rows[i]
+        numeric = np.array([isinstance(value, (int, float)) for value in row], dtype=bool)
+        if numeric.any():
+            row[numeric] = format_values(row[numeric].astype(float), metric_unit(metric))
+    return pd.DataFrame(rows, index=df.index, columns=df.columns, dtype=object)
@@ -0,0 +1,101 @@
+"""
+Import-time profile: how much of a cold start each dependency costs.
+
+    python import_profile.py                                  # the page load of app.py, then each module
+    python import_profile.py app financial_analysis --top 5
+    python import_profile.py --output imports.json
+
+Every target is imported in a fresh interpreter with `python -X importtime`, so nothing is cached between them. The
+"app" target imports the module-level imports of app.py (the app itself can't be imported outside Streamlit). Modules
+that app.py imports in its page body are not counted: this is the cost of loading the page only as long as the page
+body imports heavy modules behind a button or an upload, as it does now. The report gives the total import time of
+each target and the time spent in each top-level package it loaded, slowest first.
+"""
+import argparse
+import ast
+import json
+import os
+import subprocess
+import sys
+from collections import defaultdict
+
+repo = os.path.dirname(os.path.abspath(__file__))
+default_targets = ["app", "config", "startup_research", "financial_analysis", "deck_utils", "affinity_utils",
+                   "job_utils"]
+
+
+def module_imports(path: str) -> list:
+    """:return: Modules imported at the top level of a file, in order (imports inside functions are left out)"""
+    with open(path) as f:
+        tree = ast.parse(f.read())
+    modules = []
+    for node in tree.body:
+        if isinstance(node, ast.Import):
+            modules += [alias.name for alias in node.names]
+        elif isinstance(node, ast.ImportFrom) and node.level == 0:
+            modules.append(node.module)
+    return list(dict.fromkeys(modules))
+
+
+def parse_importtime(output: str) -> list:
+    """:return: (module, self microseconds, cumulative microseconds) of every line printed by -X importtime"""
+    imports = []
+    for line in output.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        self_us, cumulative_us, module = line[len("import time:"):].split("|")
+        imports.append((module.strip(), int(self_us), int(cumulative_us)))
+    return imports
+
+
+def profile(modules: list) -> dict:
+    """
+    Import the modules in a fresh interpreter.
+
+    :return: {"seconds": total import time, "packages": {top-level package: {"seconds", "modules"}}, "error"}
+    """
+    code = "".join(f"import {module}\n" for module in modules)
+    process = subprocess.run([sys.executable, "-X", "importtime", "-c", code], cwd=repo, capture_output=True, text=True)
+    imports = parse_importtime(process.stderr)
+    packages = defaultdict(lambda: {"seconds": 0.0, "modules": 0})
+    for module, self_us, cumulative_us in imports:
+        package = packages[module.split(".")[0]]
+        package["seconds"] += self_us / 1e6
+        package["modules"] += 1
+    errors = [line for line in process.stderr.splitlines() if not line.startswith("import time:")]
+    return {
+        "seconds": sum(self_us for module, self_us, cumulative_us in imports) / 1e6,
+        "packages": dict(sorted(packages.items(), key=lambda item: -item[1]["seconds"])),
+        "error": errors[-1] if process.returncode else "",
+    }
+
+
+def report(target: str, result: dict, top: int) -> str:
+    lines = [f"{target}: {result['seconds']:.3f}s" + (f"  (FAILED: {result['error']})" if result["error"] else "")]
+    for package, cost in list(result["packages"].items())[:top]:
+        share = cost["seconds"] / result["seconds"] if result["seconds"] else 0.0
+        lines.append(f"  {package:<28} {cost['seconds']:8.3f}s {share:6.1%} {cost['modules']:6d} modules")
+    return "\n".join(lines)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Import-time profile of the app and its modules")
+    parser.add_argument("targets", nargs="*", default=default_targets,
+                        help="modules to profile, 'app' for the page load of app.py")
+    parser.add_argument("--top", type=int, default=10, help="packages listed per target")
+    parser.add_argument("--output", help="write the results to this JSON file")
+    args = parser.parse_args(argv)
+
+    results = {}
+    for target in args.targets:
+        modules = module_imports(os.path.join(repo, "app.py")) if target == "app" else [target]
+        results[target] = profile(modules)
+        print(report(target, results[target], args.top))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+    return 1 if any(result["error"] for result in results.values()) else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
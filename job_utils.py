@@ -0,0 +1,99 @@
+import asyncio
+import threading
+import time
+import types
+from cache_utils import TTLCache, MISSING
+from concurrency_utils import BackgroundLoop, shared
+from config import cache_path, research_config, research_jobs_config
+from startup_research import conduct_research, fingerprint, website_key
+
+job_cache = TTLCache(cache_path, "research_jobs", max_memory_entries=256, max_disk_entries=5000)  # finished jobs
+
+
+def research_job_id(website: str, company_description: str = None, deck=None, refresh: bool = False) -> str:
+    """Jobs with the same inputs share an id, so the same research submitted twice runs once."""
+    return fingerprint(website_key(website), company_description or "", deck.hash if deck is not None else "",
+                       refresh)[:16]
+
+
+class ResearchJobs:
+    """
+    Runs conduct_research in the background, outside the Streamlit script runs: a rerun (a widget change, another
+    analyst's session) only reads the state of its job instead of redoing the research. Jobs run on one background
+    event loop shared by every session, at most `workers` at a time, and the others wait in the queue.
+
+    A job is a dictionary with id, status ("queued", "running", "done" or "failed"), stages (stage name -> {"status",
+    "text"}, in the order they started, text growing as it is generated), memo, company_description, sources, error,
+    submitted and finished times. Running jobs are kept in memory; finished ones are moved to job_cache, where they
+    can be read back for `ttl` seconds.
+    """
+
+    def __init__(self, workers: int = 4, ttl: float = 24 * 3600):
+        self.workers = workers
+        self.ttl = ttl
+        self.jobs = {}  # id -> job, while queued or running
+        self._semaphore = None
+        self._lock = threading.Lock()
+        self._background = BackgroundLoop("research-jobs", self._setup)
+
+    async def _setup(self):
+        self._semaphore = asyncio.Semaphore(self.workers)
+
+    def submit(self, website: str, company_description: str = None, deck=None, refresh: bool = False) -> str:
+        """
+        Queue the research of a startup, unless the same research is already queued or running.
+
+        :param deck: Decrypted deck_utils.PitchDeck, or None
+        :return: Id of the job
+        """
+        job_id = research_job_id(website, company_description, deck, refresh)
+        with self._lock:
+            if job_id in self.jobs:
+                return job_id
+            self.jobs[job_id] = {"id": job_id, "status": "queued", "stages": {}, "memo": None,
+                                 "company_description": company_description, "sources": None, "error": "",
+                                 "submitted": time.time(), "finished": None}
+        state = types.SimpleNamespace(website=website, company_description=company_description, sources=None)
+        self._background.submit(self._run(job_id, state, deck, refresh))
+        return job_id
+
+    def get(self, job_id: str) -> dict:
+        """:return: A copy of the job, or None if there is no such job (or it finished more than ttl seconds ago)"""
+        with self._lock:
+            job = self.jobs.get(job_id)
+            if job is not None:
+                return {**job, "stages": {stage: dict(progress) for stage, progress in job["stages"].items()}}
+        job = job_cache.get(job_id, self.ttl)
+        return None if job is MISSING else job
+
+    async def _run(self, job_id: str, state, deck, refresh: bool):
+        job = self.jobs[job_id]
+
+        def on_event(stage, kind, text):
+            with self._lock:
+                if kind == "start":
+                    job["stages"][stage] = {"status": "running", "text": ""}
+                elif kind == "token":
+                    job["stages"][stage]["text"] += text
+                else:
+                    job["stages"][stage] = {"status": "done", "text": text}
+
+        async with self._semaphore:
+            with self._lock:
+                job["status"] = "running"
+            try:
+                memo = await conduct_research(state, research_config, deck, refresh, on_event=on_event)
+            except Exception as e:  # reported to the session polling the job
+                update = {"status": "failed", "error": f"{type(e).__name__}: {e}"}
+            else:
+                update = {"status": "done", "memo": memo, "company_description": state.company_description,
+                          "sources": state.sources}
+        with self._lock:
+            job.update(update, finished=time.time())
+            job_cache.set(job_id, job)
+            del self.jobs[job_id]
+
+
+@shared
+def get_research_jobs() -> ResearchJobs:
+    return ResearchJobs(**research_jobs_config)
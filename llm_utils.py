@@ -0,0 +1,143 @@
+import asyncio
+import hashlib
+import json
+import httpx
+from openai import AsyncOpenAI
+from cache_utils import TTLCache, MISSING
+from concurrency_utils import BackgroundLoop, shared
+from config import llm_client_config, llm_cache_config
+
+
+def response_key(provider: str, model: str, messages: list, temperature: float = None) -> str:
+    """Hash everything that determines a completion, so identical prompts share one cached response."""
+    payload = json.dumps({"provider": provider, "model": model, "messages": messages, "temperature": temperature},
+                         sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+
+class ResponseCache:
+    """
+    Persistent LLM response cache keyed by response_key, with age- and size-based eviction and a record/replay mode.
+
+    :param mode: "cache", "record", "replay" or "off" (see config.llm_cache_config)
+    """
+
+    def __init__(self, path: str, mode: str = "cache", ttl: float = None, max_entries: int = None):
+        if mode not in ("cache", "record", "replay", "off"):
+            raise ValueError(f"Unknown LLM cache mode '{mode}'")
+        self.mode = mode
+        self.ttl = ttl
+        self.store = TTLCache(path, "llm_responses", max_memory_entries=256, max_disk_entries=max_entries)
+
+    def get(self, key: str):
+        """
+        :return: The stored response, or MISSING if the API has to be called
+        """
+        if self.mode == "cache":
+            return self.store.get(key, self.ttl)
+        if self.mode == "replay":
+            response = self.store.get(key)
+            if response is MISSING:
+                raise LookupError(f"No recorded LLM response for request {key[:12]} in replay mode")
+            return response
+        return MISSING
+
+    def set(self, key: str, response: str):
+        if self.mode in ("cache", "record"):
+            self.store.set(key, response)
+
+
+class LLMClient:
+    """
+    Process-wide async OpenAI client. Requests run on one background event loop that owns a pooled HTTP
+    connection, so the connections are reused across calls, Streamlit reruns and sessions (each of which runs its
+    own event loop), and a concurrency limit applies to all of them together. Responses go through the optional
+    ResponseCache.
+    """
+
+    def __init__(self, max_connections: int = 20, max_concurrency: int = 8, timeout: float = 120.0,
+                 max_retries: int = 2, cache: ResponseCache = None):
+        self.cache = cache
+        self.max_connections = max_connections
+        self.max_concurrency = max_concurrency
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self._client = None
+        self._semaphore = None
+        self._background = BackgroundLoop("llm-client", self._setup)
+
+    async def _setup(self):
+        """Create the client on the background loop, which owns its connections."""
+        self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        self._client = AsyncOpenAI(
+            timeout=self.timeout, max_retries=self.max_retries,
+            http_client=httpx.AsyncClient(limits=httpx.Limits(max_connections=self.max_connections,
+                                                              max_keepalive_connections=self.max_connections),
+                                          timeout=self.timeout))
+
+    async def _create(self, **kwargs):
+        async with self._semaphore:
+            completion = await self._client.chat.completions.create(**kwargs)
+        return str(completion.choices[0].message.content)
+
+    async def _stream(self, on_token, **kwargs):
+        chunks = []
+        async with self._semaphore:
+            stream = await self._client.chat.completions.create(stream=True, **kwargs)
+            async for chunk in stream:
+                token = chunk.choices[0].delta.content if chunk.choices else None
+                if token:
+                    chunks.append(token)
+                    on_token(token)
+        return "".join(chunks)
+
+    def submit(self, **kwargs):
+        """
+        Schedule a chat completion on the background loop.
+
+        :param kwargs: Arguments of chat.completions.create (model, messages, temperature, timeout, ...)
+        :return: concurrent.futures.Future of the response text
+        """
+        return self._background.submit(self._create(**kwargs))
+
+    def submit_stream(self, on_token, **kwargs):
+        """
+        Schedule a streamed chat completion on the background loop.
+
+        :param on_token: Called on the background loop with every chunk of text as it arrives
+        :return: concurrent.futures.Future of the full response text
+        """
+        return self._background.submit(self._stream(on_token, **kwargs))
+
+    async def _request(self, on_token, **kwargs) -> str:
+        if on_token is None:
+            return await asyncio.wrap_future(self.submit(**kwargs))
+        # hand the tokens over to the caller's loop, where they arrive before the result of the future
+        loop = asyncio.get_running_loop()
+        return await asyncio.wrap_future(self.submit_stream(lambda token: loop.call_soon_threadsafe(on_token, token),
+                                                            **kwargs))
+
+    async def chat(self, on_token=None, **kwargs) -> str:
+        """
+        Return the response text of a chat completion without blocking the caller's event loop.
+
+        :param on_token: Optional function called with each chunk of the response as it is generated. A cached
+            response is passed in a single chunk.
+        """
+        if self.cache is None:
+            return await self._request(on_token, **kwargs)
+        key = response_key("openai", kwargs["model"], kwargs["messages"], kwargs.get("temperature"))
+        response = self.cache.get(key)
+        if response is MISSING:
+            response = await self._request(on_token, **kwargs)
+            self.cache.set(key, response)
+        elif on_token is not None:
+            on_token(response)
+        return response
+
+
+@shared
+def get_llm_client() -> LLMClient:
+    cache = ResponseCache(llm_cache_config["path"], llm_cache_config["mode"], llm_cache_config["ttl"],
+                          llm_cache_config["max_entries"])
+    return LLMClient(**llm_client_config, cache=cache)
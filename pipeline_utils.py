@@ -0,0 +1,59 @@
+import asyncio
+
+
+class Stage:
+    """
+    One step of a research pipeline.
+
+    :param name: Name of the stage, used as the key of its result
+    :param fn: Async function called with the results of the dependencies, in the order of deps
+    :param deps: Names of the stages whose results this stage needs
+    :param timeout: Seconds after which the stage is cancelled and the pipeline fails (default: no limit)
+    """
+
+    def __init__(self, name: str, fn, deps: list = None, timeout: float = None):
+        self.name = name
+        self.fn = fn
+        self.deps = deps or []
+        self.timeout = timeout
+
+
+async def run_stages(stages: list, on_event=None) -> dict:
+    """
+    Run the stages of a DAG, each one as soon as its dependencies are done, so independent branches run concurrently.
+    If a stage fails or times out, the other stages are cancelled and its exception is raised. Cancelling the
+    caller cancels every running stage.
+
+    :param stages: List of Stage objects, each one listed after its dependencies
+    :param on_event: Optional function called with (stage name, "start", None) when a stage starts and
+        (stage name, "done", result) when it finishes
+    :return: Dictionary mapping each stage name to its result
+    """
+    seen = set()
+    for stage in stages:
+        for dep in stage.deps:
+            if dep not in seen:
+                raise ValueError(f"Stage '{stage.name}' depends on '{dep}', which is not listed before it")
+        seen.add(stage.name)
+    tasks = {}
+
+    async def run(stage):
+        args = [await tasks[dep] for dep in stage.deps]
+        if on_event is not None:
+            on_event(stage.name, "start", None)
+        try:
+            result = await asyncio.wait_for(stage.fn(*args), stage.timeout)
+        except asyncio.TimeoutError:
+            raise TimeoutError(f"Stage '{stage.name}' timed out after {stage.timeout} seconds")
+        if on_event is not None:
+            on_event(stage.name, "done", result)
+        return result
+
+    for stage in stages:
+        tasks[stage.name] = asyncio.ensure_future(run(stage))
+    try:
+        await asyncio.gather(*tasks.values())
+    finally:
+        for task in tasks.values():
+            task.cancel()
+    return {name: task.result() for name, task in tasks.items()}
@@ -0,0 +1,151 @@
+import asyncio
+import threading
+import time
+import anthropic
+import openai
+from concurrency_utils import shared
+from config import research_config, llm_providers, provider_router_config
+
+# errors after which the call is retried with the next provider
+provider_errors = (anthropic.APIError, openai.APIError, TimeoutError)
+
+
+class CircuitBreaker:
+    """
+    Stops routing calls to a provider after failure_threshold consecutive failures or calls slower than
+    slow_seconds. After cooldown seconds one call is let through again (half-open): its success closes the breaker,
+    its failure opens it for another cooldown. Until it finishes, the breaker stays unavailable to the other calls.
+    """
+
+    def __init__(self, failure_threshold: int = 3, cooldown: float = 300, slow_seconds: float = None):
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.slow_seconds = slow_seconds
+        self.failures = 0
+        self.opened_at = None
+        self.trial = False  # a call is being let through after the cooldown
+        self._lock = threading.Lock()
+
+    def available(self) -> bool:
+        with self._lock:
+            return self.opened_at is None or (not self.trial and time.monotonic() - self.opened_at >= self.cooldown)
+
+    def start(self):
+        """Mark the start of a call, which is the trial call if the breaker is open."""
+        with self._lock:
+            if self.opened_at is not None:
+                self.trial = True
+
+    def release(self):
+        """End a call without an outcome (e.g. cancelled), freeing the trial slot."""
+        with self._lock:
+            self.trial = False
+
+    def record(self, seconds: float, failed: bool = False):
+        with self._lock:
+            self.trial = False
+            if failed or (self.slow_seconds is not None and seconds > self.slow_seconds):
+                self.failures += 1
+                if self.opened_at is not None or self.failures >= self.failure_threshold:
+                    self.opened_at = time.monotonic()  # (re)open, also when the trial call after a cooldown failed
+            else:
+                self.failures = 0
+                self.opened_at = None
+
+
+class ProviderRouter:
+    """
+    Chooses the LLM provider of each call instead of switching it for the whole process: calls go to the first
+    provider whose circuit breaker is closed, and fail over to the next one on provider errors. With hedge_after set,
+    a call still running after that many seconds is also sent to the next provider and the first answer wins.
+
+    :param providers: Dictionary mapping each provider name to its gpt-researcher settings, in order of preference
+    """
+
+    def __init__(self, providers: dict, failure_threshold: int = 3, cooldown: float = 300, slow_seconds: float = None,
+                 hedge_after: float = None):
+        self.providers = providers
+        self.hedge_after = hedge_after
+        self.breakers = {name: CircuitBreaker(failure_threshold, cooldown, slow_seconds) for name in providers}
+
+    def order(self) -> list:
+        """Providers to try, closed breakers first; if every breaker is open, all of them are tried anyway."""
+        available = [name for name in self.providers if self.breakers[name].available()]
+        return available + [name for name in self.providers if name not in available]
+
+    async def _attempt(self, name, fn, args, kwargs):
+        self.breakers[name].start()
+        started = time.monotonic()
+        try:
+            result = await fn(*args, provider=self.providers[name], **kwargs)
+        except provider_errors:
+            self.breakers[name].record(time.monotonic() - started, failed=True)
+            raise
+        except BaseException:  # cancelled hedge, or an error that says nothing about the provider
+            self.breakers[name].release()
+            raise
+        self.breakers[name].record(time.monotonic() - started)
+        return result
+
+    async def call(self, fn, *args, on_token=None, **kwargs):
+        """
+        Await fn(*args, provider=settings of the chosen provider, **kwargs).
+
+        :param on_token: Passed on to fn. Only the tokens of one attempt are forwarded: the first one to stream,
+            until it fails. Then the next attempt to stream takes over, starting with the tokens it generated so far.
+        """
+        remaining = self.order()
+        streaming = []  # name of the attempt whose tokens are forwarded
+        buffers = {}  # tokens of the other attempts
+
+        def tokens(name):
+            def forward(token):
+                if not streaming:
+                    streaming.append(name)
+                    for buffered in buffers.pop(name, []):
+                        on_token(buffered)
+                if streaming[0] == name:
+                    on_token(token)
+                else:
+                    buffers.setdefault(name, []).append(token)
+            return forward
+
+        attempts = {}
+
+        def start(name):
+            extra = {"on_token": tokens(name)} if on_token is not None else {}
+            task = asyncio.ensure_future(self._attempt(name, fn, args, {**kwargs, **extra}))
+            attempts[task] = name
+            return task
+
+        error = None
+        while remaining:
+            running = {start(remaining.pop(0))}
+            try:
+                while running:
+                    hedge = self.hedge_after if remaining and len(running) == 1 else None
+                    done, running = await asyncio.wait(running, timeout=hedge, return_when=asyncio.FIRST_COMPLETED)
+                    if not done:  # too slow, ask the next provider as well
+                        running.add(start(remaining.pop(0)))
+                        continue
+                    for task in done:
+                        if task.exception() is None:
+                            return task.result()
+                        if not isinstance(task.exception(), provider_errors):
+                            raise task.exception()
+                        error = task.exception()
+                        print(f"LLM provider failed, trying the next one: {error!r}")
+                        buffers.pop(attempts[task], None)
+                        if streaming and streaming[0] == attempts[task]:
+                            streaming.clear()  # forward the tokens of the attempt that replaces it
+            finally:
+                for task in running:
+                    task.cancel()
+        raise error
+
+
+@shared
+def get_provider_router() -> ProviderRouter:
+    primary = research_config["llm_provider"]
+    providers = {name: llm_providers[name] for name in sorted(llm_providers, key=lambda name: name != primary)}
+    return ProviderRouter(providers, **provider_router_config)
@@ -1,17 +1,82 @@
 import os.path
 import io
-from openai import OpenAI
-from urllib.parse import urlparse, urlunparse
-from gpt_researcher import GPTResearcher
-import streamlit as st
-import PyPDF2
-from io import BytesIO
-import pymupdf
-import anthropic
-async def get_report(source: str, prompt: str, report_type: str, agent=None,role=None,config_path = None, verbose = True) -> str:
-    researcher = GPTResearcher(prompt, report_type, report_source=source, config_path = config_path, agent= agent, role=role, verbose = verbose)
+import atexit
+import shutil
+import time
+import asyncio
+import json
+import hashlib
+import re
+import tempfile
+from functools import lru_cache
+from urllib.parse import urlparse
+from pipeline_utils import Stage, run_stages
+from llm_utils import get_llm_client
+from provider_utils import get_provider_router
+from cache_utils import TTLCache
+from config import cache_path, research_cache_ttl, report_sections, unchecked_sections, deck_retrieval, deck_queries
+research_cache = TTLCache(cache_path, "research")
+# a line holding only a section name, optionally numbered, bold or a markdown heading, or followed by ": ..."
+section_names = "|".join(re.escape(name) for name in report_sections)
+section_header = re.compile(rf"^[ \t]*(?:#{{1,6}}[ \t]*)?(?:\*\*|__)?[ \t]*(?:\d+[.)][ \t]*)?"
+                            rf"(?P<name>{section_names})[ \t]*(?:\*\*|__)?[ \t]*(?::.*)?$", re.IGNORECASE | re.MULTILINE)
+
+class ReportStream:
+    """Stands in for the websocket of GPTResearcher, which sends it the paragraphs of the report as they are written."""
+    def __init__(self, on_token):
+        self.on_token = on_token
+
+    async def send_json(self, data):
+        if data.get("type") == "report":
+            self.on_token(data["output"])
+
+def report_stream(on_token):
+    return ReportStream(on_token) if on_token is not None else None
+
+@lru_cache(maxsize=1)
+def researcher_config_folder() -> str:
+    """Temporary folder of the gpt-researcher config files, created on first use and removed at exit."""
+    folder = tempfile.mkdtemp(prefix="researcher-config-")
+    atexit.register(shutil.rmtree, folder, True)
+    return folder
+
+@lru_cache(maxsize=None)
+def write_researcher_config(settings: str) -> str:
+    path = os.path.join(researcher_config_folder(), hashlib.sha256(settings.encode()).hexdigest()[:16] + ".json")
+    with open(path, "w") as f:
+        f.write(settings)
+    return path
+
+def researcher_config(provider: dict = None, doc_path: str = None):
+    """
+    gpt-researcher config file overriding the environment for one researcher, so that the provider and documents
+    of a call don't leak into the concurrent ones.
+
+    :param provider: LLM settings of the provider (see config.llm_providers)
+    :param doc_path: Folder of the local documents
+    :return: Path of the config, or None if there is nothing to override
+    """
+    settings = dict(provider or {})
+    if doc_path is not None:
+        settings["doc_path"] = doc_path
+    return write_researcher_config(json.dumps(settings, sort_keys=True)) if settings else None
+
+def new_researcher(*args, **kwargs):
+    """
+    GPTResearcher(*args, **kwargs), importing gpt-researcher (seconds) only once a report is written.
+    Every researcher gets its own visited_urls: the default of GPTResearcher is one set shared by the whole process.
+    """
+    from gpt_researcher import GPTResearcher
+    kwargs.setdefault("visited_urls", set())
+    return GPTResearcher(*args, **kwargs)
+
+async def get_report(source: str, prompt: str, report_type: str, agent=None,role=None,config_path = None, verbose = True, sources: list = None, on_token=None, provider: dict = None, doc_path: str = None) -> str:
+    config_path = config_path or researcher_config(provider, doc_path)
+    researcher = new_researcher(prompt, report_type, report_source=source, config_path = config_path, agent= agent, role=role, verbose = verbose, websocket=report_stream(on_token))
     research_result = await researcher.conduct_research()
     report = await researcher.write_report()
+    if sources is not None:  # collect the urls the researcher visited
+        sources.extend(sorted(getattr(researcher, "visited_urls", [])))
     return report
 
 def build_prompt(prompt: str, company_website: str, company_description: str):
@@ -19,10 +84,9 @@ def build_prompt(prompt: str, company_website: str, company_description: str):
 
 
 #this function integrates the two reports, online and offline
-def combine_reports(prompt, offline, online):
-    client = OpenAI()
-
-    completion = client.chat.completions.create(
+async def combine_reports(prompt, offline, online, on_token=None):
+    response = await get_llm_client().chat(
+    on_token=on_token,
     model="gpt-4o",
     messages=[
       {"role": "system", "content": "You are a helpful assistant that can integrate two reports into a single one. You do not do research of your own. You only copy and paste statements from each report and reformat. Do not use any special fonts, italics, or font colors. You many only bold the section headers and underline the reference links."},
@@ -31,65 +95,127 @@ def combine_reports(prompt, offline, online):
     ]
     )
 
-    response = str(completion.choices[0].message.content)
     return response
 
 def extract_text_from_elements(elements):
     return " ".join([element.text for element in elements if element.text.strip()])
 
 def validate_url(url):
+    url = url.strip()
     parsed = urlparse(url)
-    if not parsed.scheme:
-        return urlunparse(('https', *parsed[1:]))
+    if not parsed.scheme:  # "example.com" has no netloc until it gets a scheme
+        return "https://" + url.lstrip("/")
     return url
 
-async def generate_summary(url):
+def website_key(url):
+    """Normalize a website so that e.g. "Example.com", "https://www.example.com/" share their cached research."""
+    parsed = urlparse(validate_url(url))
+    host = parsed.netloc.lower()
+    if host.startswith("www."):
+        host = host[4:]
+    return host + parsed.path.rstrip("/")
+
+def fingerprint(*inputs):
+    return hashlib.sha256(json.dumps(inputs, sort_keys=True, default=str).encode()).hexdigest()
+
+async def generate_summary(url, on_token=None, provider: dict = None):
     sourcelist = [url]
     print("start generating summary")
     prompt = "Give me a 5 sentence overview of the company at + " + url + " especially what products it offers and its end users, and the industry it operates in."
-    researcher = GPTResearcher(prompt, report_type="custom_report", verbose = True, source_urls=sourcelist)
+    researcher = new_researcher(prompt, report_type="custom_report", verbose = True, source_urls=sourcelist, websocket=report_stream(on_token), config_path=researcher_config(provider))
     research_result = await researcher.conduct_research()
     report = await researcher.write_report()
     return report
 
-#this is the checkpoint function, it takes in a report, website, and company description
-#it then uses GPT to do online research and check the validity of any claims. 
-#It seeks to correct the information and outputs the corrected report
-#it is called after each report it made. If no description exists, it makes the description.
-def check_point(report, website, summary):
-    client = OpenAI()
-
-    completion = client.chat.completions.create(
+def split_sections(report):
+    """
+    Split a report at its section headers (see config.report_sections).
+
+    :return: List of (section name, text) tuples in the order of the report. The name is None for the text before the
+        first header, e.g. the title.
+    """
+    sections = []
+    start, name = 0, None
+    for match in section_header.finditer(report):
+        sections.append((name, report[start:match.start()]))
+        start = match.start()
+        name = next(section for section in report_sections if section.lower() == match.group("name").lower())
+    sections.append((name, report[start:]))
+    return [(name, text) for name, text in sections if text.strip()]
+
+
+class OrderedTokens:
+    """
+    Forward the tokens of parts of a text that are generated concurrently in the order of the parts: the tokens of a
+    part are held back until every part before it is finished.
+    """
+    def __init__(self, on_token, count):
+        self.on_token = on_token
+        self.buffers = [[] for _ in range(count)]
+        self.finished = [False] * count
+        self.current = 0
+
+    def token(self, part, token):
+        if part == self.current:
+            self.on_token(token)
+        else:
+            self.buffers[part].append(token)
+
+    def finish(self, part):
+        self.finished[part] = True
+        while self.current < len(self.finished) and self.finished[self.current]:
+            self.current += 1
+            if self.current < len(self.finished):
+                for token in self.buffers[self.current]:
+                    self.on_token(token)
+                self.buffers[self.current] = []
+
+
+async def check_section(section, website, summary, on_token=None):
+    response = await get_llm_client().chat(
+    on_token=on_token,
     model="gpt-4o",
     messages=[
       {"role": "system", "content": "You are a helpful assistant that fact checks reports. In addition to fact-checking, you also modify fonts, colors, and text to standardize formats"},
-      {"role": "user", "content": "Using this website: " + website + " and this company description: \'" + summary + "\' First understand what the company does. Then, going one bullet point at a time, fact check the following report \'" + report + "\' If a claim is accurate, make no modifications or additions to the report. Do not add a new line or mark the line in any way or form. If the claim is inaccurate, modify the line with the correct information."},
-      {"role": "assistant", "content": "Stick to the same format as the report. If a claim is accurate, make no modifications. Only modify when a claim is inaccurate. There are eight sections: Website, Team, Market, Product, Traction, Exit Strategy, Concerns, and Deal Structure. Each section begins with factual statements regarding the section topic and is followed by a Questions section. Do not modify the Questions section."}
+      {"role": "user", "content": "Using this website: " + website + " and this company description: \'" + summary + "\' First understand what the company does. Then, going one bullet point at a time, fact check the following section of a report \'" + section + "\' If a claim is accurate, make no modifications or additions to the section. Do not add a new line or mark the line in any way or form. If the claim is inaccurate, modify the line with the correct information."},
+      {"role": "assistant", "content": "Stick to the same format as the section and keep its header line. If a claim is accurate, make no modifications. Only modify when a claim is inaccurate. The section begins with factual statements regarding the section topic and is followed by a Questions section. Do not modify the Questions section. Only return the section, nothing else."}
     ],
      temperature = 0.2
     )
 
-    response = str(completion.choices[0].message.content)
     return response
 
-
-#this downloads the file
-async def new_export_pdf(uploaded_file):
-  # Save the file
-  file_path = os.path.join("company", "pitchdeck.pdf")
-  os.makedirs("company", exist_ok=True)
-
-  with open(file_path, "wb") as f:
-    f.write(uploaded_file.getbuffer())
+#this is the checkpoint function, it takes in a report, website, and company description
+#it then uses GPT to do online research and check the validity of any claims. 
+#It seeks to correct the information and outputs the corrected report
+#it is called after each report it made. If no description exists, it makes the description.
+#The sections of the report are checked concurrently and put back together in order. As the responses are cached by
+#content, the sections that didn't change since an earlier check are not sent again.
+async def check_point(report, website, summary, on_token=None):
+    sections = split_sections(report)
+    tokens = OrderedTokens(on_token or (lambda token: None), len(sections))
+    only_section = len(sections) == 1
+
+    async def check(part, name, text):
+        if name in unchecked_sections or (name is None and not only_section):  # references, title
+            checked = text
+            tokens.token(part, text)
+        else:
+            response = await check_section(text, website, summary, on_token=lambda token: tokens.token(part, token))
+            separator = text[len(text.rstrip()):]  # keep the blank lines between the sections
+            checked = response.strip() + separator
+            tokens.token(part, separator)
+        tokens.finish(part)
+        return checked
+
+    return "".join(await asyncio.gather(*[check(part, name, text) for part, (name, text) in enumerate(sections)]))
 
 
 #this function takes in a report and identifies the industry and sub-sector of a company
-def identify_industry(report):
+async def identify_industry(report):
     
     industry = "Biotech"
-    client = OpenAI()
-
-    completion = client.chat.completions.create(
+    response = await get_llm_client().chat(
     model="gpt-4o",
     messages=[
       {"role": "system", "content": "You are an expert in venture capital and assist non-experts in making assessments of specific technical fields."},
@@ -97,8 +223,6 @@ def identify_industry(report):
       {"role": "assistant", "content": "Respond by using 1-3 words to decribe the field. Add nothing else. Be specific."}
     ]
     )
-    
-    response = str(completion.choices[0].message.content)
 
     return industry, response
 
@@ -110,17 +234,15 @@ async def industry_sector_report(industry, sector):
                 this industry and this sector. Focus on what distinguishes venture capital investing in this industry and sector from others.
                 Include a short summary of how the industry and sector are performing."""
 
-    researcher = GPTResearcher(query=prompt, 
+    researcher = new_researcher(query=prompt, 
                                  report_type=report_type, source_urls=sources, report_source='sources', verbose=True)
     research_result = await researcher.conduct_research()
     report = await researcher.write_report()
 
     return report
 
-def expert_opinion(company, market):
-    client = OpenAI()
-
-    completion = client.chat.completions.create(
+async def expert_opinion(company, market):
+    response = await get_llm_client().chat(
     model="gpt-4o",
     messages=[
       {"role": "system", "content": "You are an expert in venture capital and assist non-experts in making assessments of specific technical fields."},
@@ -128,63 +250,101 @@ def expert_opinion(company, market):
       {"role": "assistant", "content": "You are an expert who sees the connections between large market trands and individual companies.."}
     ]
     )
-    
-    response = str(completion.choices[0].message.content)
 
     return response
 
-#pulled from internet and works!
-def is_encrypted(pdf_content):
-    """Check if a PDF file is encrypted."""
-    reader = PyPDF2.PdfReader(BytesIO(pdf_content))
-    return reader.is_encrypted
-
-async def decrypt_pdf(pdf_content, password):
-    """Decrypt a password-protected PDF."""
-    doc = pymupdf.open(stream=pdf_content.read(), filetype="pdf")
-    
-    # Check if the PDF is not encrypted
-    if not doc.is_encrypted:
-        return None, "The PDF file is not encrypted."
+async def conduct_research(session_state, research_config, deck=None, refresh=False, on_event=None):
+    """
+    Draft the call memo. The online branch (web report + fact check) and, when a deck was uploaded, the offline
+    branch (local report + fact check) only share the company summary, so they run concurrently before being combined.
+    Stage timeouts are read from research_config["stage_timeouts"].
 
-    if doc.authenticate(password):
-        output_pdf = BytesIO()
-        doc.save(output_pdf)
-        output_pdf.seek(0)  # Reset the file pointer to the beginning
-        await new_export_pdf(output_pdf) 
-        return output_pdf, "PDF decrypted successfully!"
-    else:
-        return None, "Incorrect password! Unable to decrypt PDF."
+    The output of every stage is cached per website (see website_key) together with a fingerprint of its inputs, and
+    reused while the inputs are unchanged and the entry is younger than research_cache_ttl. With refresh=True the
+    age is ignored: only the stages whose inputs changed (e.g. a new pitch deck or an edited description) run again.
+    The sources of the online report are stored in session_state.sources.
 
+    on_event, if given, is called with (stage name, kind, text) as the pipeline progresses: kind is "start" when a stage
+    starts, "token" for every chunk of text it generates and "done" with its full output (see
+    job_utils.ResearchJobs).
 
-async def conduct_research(session_state, research_config, uploaded_files):
+    session_state only needs the website, company_description and sources attributes, so headless callers can pass a
+    plain object (see batch_research.py). deck is a decrypted deck_utils.PitchDeck, or None.
+    """
     website = session_state.website
-    try:
-        # Use Anthropic Claude model. If it has outages, fall back to open AI
+    site = website_key(website)
+    timeouts = research_config.get("stage_timeouts", {})
+
+    def tokens(stage):
+        return (lambda token: on_event(stage, "token", token)) if on_event is not None else None
+
+    def notify(stage, kind, output):
+        if on_event is not None:
+            on_event(stage, kind, output[0] if isinstance(output, tuple) else output)  # drop the report sources
+
+    async def cached(stage, inputs, fn, *args, **kwargs):
+        key = f"{site}:{stage}"
+        inputs_fingerprint = fingerprint(*inputs)
+        entry = research_cache.get_entry(key)
+        if entry is not None and entry[0]["inputs"] == inputs_fingerprint \
+                and (refresh or time.time() - entry[1] <= research_cache_ttl):
+            return entry[0]["output"]
+        output = await fn(*args, **kwargs)
+        research_cache.set(key, {"inputs": inputs_fingerprint, "output": output})
+        return output
+
+    async def summary():
         if not session_state.company_description:
-            session_state.company_description = await generate_summary(website)
-        prompt = build_prompt(research_config["prompt"], st.session_state.website, st.session_state.company_description)
-        online_report = await get_report("web", prompt, research_config["report_type"],
-                                         research_config["agent"], research_config["role"], verbose=False)
-    except anthropic.InternalServerError:
-        os.environ["LLM_PROVIDER"] = "openai"
-        os.environ["FAST_LLM_MODEL"] = "gpt-4o-mini"
-        os.environ["SMART_LLM_MODEL"] = "gpt-4o"
-        if not st.session_state.company_description:
-            st.session_state.company_description = await generate_summary(website)
-        prompt = build_prompt(research_config["prompt"], website, st.session_state.company_description)
-        online_report = await get_report("web", prompt, research_config["report_type"],
-                                         research_config["agent"], research_config["role"], verbose=False)
-
-    online_report = check_point(online_report, website=website, summary=st.session_state.company_description)
-    # code change making more
-    if uploaded_files is not None:  # if document provided
-        offline_report = await get_report("local", prompt, research_config["report_type"],
-                                          research_config["agent"], research_config["role"], verbose=False)
-
-        offline_report = check_point(offline_report, website=website, summary=st.session_state.company_description)
-
-        report = combine_reports(research_config["prompt"], offline_report, online_report)
-    else:
-        report = online_report
-    return report
\ No newline at end of file
+            session_state.company_description = await cached("summary", [site], get_provider_router().call,
+                                                             generate_summary, website,
+                                                             on_token=tokens("summary"))
+        return session_state.company_description
+
+    def report_stage(name, source, inputs, deck=None):
+        async def report(company_description):
+            prompt = build_prompt(research_config["prompt"], website, company_description)
+
+            async def run():
+                sources = []
+                # extracting and indexing the deck is CPU-bound, keep it off the event loop shared by all the jobs
+                doc_path = await asyncio.to_thread(deck.export) if deck is not None else None
+                report = await get_provider_router().call(get_report, source, prompt, research_config["report_type"],
+                                                          research_config["agent"], research_config["role"],
+                                                          doc_path=doc_path,
+                                                          verbose=False, sources=sources, on_token=tokens(name))
+                return report, sources
+
+            return await cached(f"{source}_report", inputs + [site, company_description, research_config["prompt"],
+                                                              research_config["report_type"], research_config["agent"],
+                                                              research_config["role"]], run)
+        return report
+
+    def fact_check_stage(name):
+        async def fact_check(report, company_description):
+            return await cached(name, [report[0], site, company_description], check_point, report[0],
+                                website, company_description, on_token=tokens(name))
+        return fact_check
+
+    async def combine(offline_report, online_report):
+        return await cached("combine", [research_config["prompt"], offline_report, online_report], combine_reports,
+                            research_config["prompt"], offline_report, online_report, on_token=tokens("combine"))
+
+    stages = [
+        Stage("summary", summary, timeout=timeouts.get("summary")),
+        Stage("online_report", report_stage("online_report", "web", []), ["summary"], timeouts.get("report")),
+        Stage("online_check", fact_check_stage("online_check"), ["online_report", "summary"],
+              timeouts.get("check_point")),
+    ]
+    if deck is not None:  # if document provided
+        stages += [
+            Stage("offline_report", report_stage("offline_report", "local",
+                                                     [deck.hash, deck_retrieval, deck_queries], deck), ["summary"],
+                  timeouts.get("report")),
+            Stage("offline_check", fact_check_stage("offline_check"), ["offline_report", "summary"],
+                  timeouts.get("check_point")),
+            Stage("combine", combine, ["offline_check", "online_check"], timeouts.get("combine_reports")),
+        ]
+    results = await run_stages(stages, notify)
+    session_state.sources = results["online_report"][1]
+    return results["combine"] if deck is not None else results["online_check"]
+